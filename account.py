@@ -0,0 +1,562 @@
+from abc import abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from queue import Empty, Queue
+from threading import Event, Lock, Thread
+from time import perf_counter, time
+import traceback
+from typing import Callable, Dict, List, Optional, Set, Tuple, Union
+from requests.cookies import RequestsCookieJar
+from steampy.models import TradeOfferState
+
+from circuit_breaker import API, BUFF, DEFAULT_HOSTS, SESSION, STEAM, UNKNOWN, CircuitBreakers, ErrorInfo, classify_error
+from notification_tracker import NotificationTracker
+from metrics import EXCEPTIONS_TOTAL, ORDER_ACTION_SECONDS, RELOGINS_TOTAL, SESSION_REFRESHES_TOTAL, TICK_SECONDS
+from pipeline import TaskType, TradePipeline, TradeTask
+from proxy_pool import ProxySelector
+from rate_limiter import Priority, request_priority
+from scheduler import AdaptivePollScheduler, FixedPollScheduler
+from session_refresher import SessionRefresher
+from exceptions import SteamConfirmationError
+from steam import AdvancedSteamClient
+from trade_offer_cache import TradeOfferCache
+from trade_store import TradeIdSet, TradeIdStore
+from buff163.client import BaseBuff163Client, Buff163Client
+from buff163.models import Order
+
+
+class BaseAccount:
+    # State and decisions shared by the threaded and the asyncio account, subclasses only make the requests
+    BACKOFF_BASE = 5
+    BACKOFF_MAX = 1800
+    MAX_CONCURRENT_FETCHES = 4
+    MAX_FIRST_SEEN = 10000
+    # failures in a row after which api and unknown errors check if the steam session is alive
+    STEAM_CHECK_AFTER = 2
+
+    def __init__(self, account_cfg, cookies: RequestsCookieJar, steam: AdvancedSteamClient,
+                 buff: BaseBuff163Client, scheduler: Union[FixedPollScheduler, AdaptivePollScheduler], notifiers=None,
+                 trade_store: Optional[TradeIdStore] = None, proxy_selector: Optional[ProxySelector] = None,
+                 session_refresher: Optional[SessionRefresher] = None):
+        self._account_cfg = account_cfg
+        self.username = self._account_cfg['username']
+        self.cookies = cookies
+        self.steam = steam
+        self.buff = buff
+        self.scheduler = scheduler
+        self.notifiers = notifiers
+        self.proxy_selector = proxy_selector
+        self.session_refresher = session_refresher
+        self.notification_tracker = NotificationTracker(
+            self._account_cfg.get('notification_recheck_period', NotificationTracker.RECHECK_PERIOD))
+        self.breakers = CircuitBreakers(self.username, self.BACKOFF_BASE, self.BACKOFF_MAX)
+        self.known_ids = TradeIdSet(self.username, 'known', trade_store)
+        self.accepted_trade_ids = TradeIdSet(self.username, 'accepted', trade_store)
+        self.confirmed_trade_ids = TradeIdSet(self.username, 'confirmed', trade_store)
+        self.tick_actions = 0
+        # trade or order id -> time it was first seen, for order to action latency
+        self.first_seen: Dict[str, float] = {}
+        self._first_seen_lock = Lock()
+        self.trade_offers = TradeOfferCache(self.steam) if self._account_cfg.get('check_trade_offers', True) else None
+        # breakers opened by failed trade actions, a successful poll does not probe them
+        self.action_breaker_keys: Set[str] = set()
+
+    def mark_seen(self, order_id: str):
+        with self._first_seen_lock:
+            if order_id not in self.first_seen:
+                self.first_seen[order_id] = time()
+                while len(self.first_seen) > self.MAX_FIRST_SEEN:
+                    del self.first_seen[next(iter(self.first_seen))]
+
+    def observe_action(self, order_id: str, action: str):
+        with self._first_seen_lock:
+            first_seen = self.first_seen.pop(order_id, None)
+
+        if first_seen is not None:
+            ORDER_ACTION_SECONDS.observe(time() - first_seen, account=self.username, action=action)
+
+    def on_trade_accepted(self, tradeofferid: str):
+        self.accepted_trade_ids.add(tradeofferid)
+        if self.trade_offers is not None:
+            self.trade_offers.set_state(tradeofferid, TradeOfferState.Accepted)
+
+        self.observe_action(tradeofferid, 'accept')
+        print(f'[{self.username}] Success')
+
+    def on_trades_confirmed(self, tradeofferids: List[str], confirmed: List[str]):
+        self.confirmed_trade_ids.update(confirmed)
+        for tradeofferid in confirmed:
+            self.observe_action(tradeofferid, 'confirm')
+            print(f'[{self.username}] Confirmed trade {tradeofferid}')
+
+        # confirmations may not be listed yet, the failed ones are retried
+        not_confirmed = [tradeofferid for tradeofferid in tradeofferids if tradeofferid not in confirmed]
+        if len(not_confirmed) > 0:
+            raise SteamConfirmationError(f'Failed to confirm trades {", ".join(not_confirmed)}')
+
+    def on_offers_sent(self, ids: List[str]):
+        self.known_ids.update(ids)
+        for order_id in ids:
+            self.observe_action(order_id, 'send_offer')
+
+    @staticmethod
+    def add_orders_to_deliver(orders: List[Order], page: List[Order], count: int) -> bool:
+        # every order to deliver needs an action, pages are read until all counted orders are found.
+        # Returns True when no more pages are needed
+        orders.extend(page)
+        return len(orders) >= count
+
+    def add_orders_to_send_offer(self, orders: List[Order], page: List[Order], count: int) -> bool:
+        # buy order history is newest first, it is read until the pending orders are found.
+        # A known order ends the read only if the orders found cover the count: an older order
+        # whose offer failed is still pending, and the history is read further to find it
+        for order in page:
+            if order.id in self.known_ids:
+                if len(orders) >= count:
+                    return True
+
+                continue
+
+            if not order.is_seller_asked_to_send_offer and not order.has_sent_offer:
+                orders.append(order)
+
+        return len(orders) >= count
+
+    def sort_orders_to_deliver(self, games_data: List[List[Order]]) -> Tuple[List[str], List[str], List[str]]:
+        # returns trade offer ids to confirm and to accept, and order ids to send offers for
+        ids_to_confirm = []
+        ids_to_accept = []
+        ids_to_send_trade = []
+        for orders in games_data:
+            for order in orders:
+                need_send_offer = order.is_seller_asked_to_send_offer or order.type == 2
+                if need_send_offer and order.state == 'DELIVERING':
+                    ids_to_confirm.append(order.tradeofferid)
+
+                if order.id in self.known_ids:
+                    continue
+
+                if need_send_offer:
+                    if not order.has_sent_offer:
+                        ids_to_send_trade.append(order.id)
+
+                else:
+                    ids_to_accept.append(order.tradeofferid)
+
+        return ids_to_confirm, ids_to_accept, ids_to_send_trade
+
+    def is_busy(self, notifications) -> bool:
+        categories = []
+        if self._account_cfg.get('process_sell_offers', True):
+            categories.append('to_deliver_order')
+
+        if self._account_cfg.get('process_buy_offers', True):
+            categories.extend(('to_send_offer_order', 'to_accept_offer_order'))
+
+        return self.tick_actions > 0 or any(sum(notifications[category].values()) > 0 for category in categories)
+
+    def start_tick(self) -> float:
+        tick_start = perf_counter()
+        self.tick_actions = 0
+        self.update_proxies()
+        if self.trade_offers is not None:
+            self.trade_offers.invalidate()
+
+        return tick_start
+
+    def finish_tick(self, tick_start: float, notifications) -> float:
+        # returns how long to wait before the next tick
+        TICK_SECONDS.observe(perf_counter() - tick_start, account=self.username)
+        self.breakers.record_success(exclude=self.action_breaker_keys)
+        busy = self.is_busy(notifications)
+        if not busy:
+            self.refresh_sessions()
+
+        return self.scheduler.next_delay(busy)
+
+    def update_config(self, account_cfg: dict):
+        # the config is shared with the clients, settings read on every tick apply from the next one
+        for key in set(self._account_cfg) - set(account_cfg):
+            del self._account_cfg[key]
+
+        self._account_cfg.update(account_cfg)
+
+    def set_proxies(self, proxy_selector: Optional[ProxySelector], proxies: Dict[str, str]):
+        self.proxy_selector = proxy_selector
+        if proxy_selector is None:
+            self.steam.switch_proxies(proxies)
+            self.buff.switch_proxies(proxies)
+
+        else:
+            self.update_proxies()
+
+    def update_proxies(self):
+        # moves both sessions to the best proxy of the pool, if the current one degraded
+        if self.proxy_selector is None:
+            return
+
+        proxies = self.proxy_selector.update()
+        if proxies is not None:
+            self.steam.switch_proxies(proxies)
+            self.buff.switch_proxies(proxies)
+
+    def refresh_sessions(self):
+        # sessions close to expiry are renewed in the background while the account is idle
+        if self.session_refresher is None:
+            return
+
+        side = self.session_refresher.get_due_side(self.username, self.cookies)
+        if side is None or not self.session_refresher.try_acquire(self.username):
+            return
+
+        print(f'[{self.username}] Refreshing {side} session before it expires')
+        self.start_session_refresh(side)
+
+    @abstractmethod
+    def start_session_refresh(self, side: str):
+        pass
+
+    def finish_session_refresh(self, side: str, exception: Optional[Exception]):
+        if exception is not None:
+            print(f'[{self.username}] Failed to refresh {side} session: {exception.__class__.__name__}: {exception}')
+
+        SESSION_REFRESHES_TOTAL.inc(account=self.username, side=side, status='ok' if exception is None else 'error')
+        self.session_refresher.release(self.username, exception is None)
+
+    def notify_exception(self, exception: Exception):
+        # notifiers only queue the notification, it is safe to call them from the event loop
+        if self.notifiers:
+            for notifier in self.notifiers:
+                notifier.notify_exception(self.username, exception)
+
+    def record_exception(self, exception: Exception) -> Tuple[ErrorInfo, float]:
+        # returns the error and how long to wait before the next tick
+        EXCEPTIONS_TOTAL.inc(account=self.username, exception=exception.__class__.__name__)
+        error = classify_error(exception)
+        delay = self.breakers.record_failure(error)
+        print(f'[{self.username}] {error.kind.capitalize()} error ({error.key}): '
+              f'{exception.__class__.__name__}: {exception}')
+        if self.breakers.get(error).failures == 1:
+            traceback.print_exc()
+
+        if self.breakers.should_notify(error):
+            self.notify_exception(exception)
+
+        return error, delay
+
+    def should_check_steam_session(self, error: ErrorInfo) -> bool:
+        # a logged out steam session mostly shows up as api errors or broken json instead of a login error
+        return (error.kind in (API, UNKNOWN) and error.side in (STEAM, None)
+                and self.breakers.get(error).failures >= self.STEAM_CHECK_AFTER)
+
+    def on_steam_session_check(self, error: ErrorInfo, alive: bool) -> ErrorInfo:
+        # returns the error to handle, a session error if the steam session is not alive
+        if alive:
+            return error
+
+        print(f'[{self.username}] Steam session is not alive')
+        return ErrorInfo(SESSION, DEFAULT_HOSTS[STEAM], STEAM)
+
+    def get_relogin_delay(self, error: ErrorInfo) -> float:
+        # the tick after the first relogin is the probe, a session which keeps failing after relogins backs off
+        if self.breakers.get(error).failures == 1:
+            return 0
+
+        return self.breakers.get_delay(error)
+
+    def record_login_failure(self, exception: Exception, delay: float) -> float:
+        print(f'[{self.username}] Failed to login: {exception.__class__.__name__}: {exception}')
+        self.notify_exception(exception)
+        return max(delay, self.breakers.record_failure(classify_error(exception)))
+
+
+class Account(Thread, BaseAccount):
+    TRADE_WORKERS = 2
+    # how long a stopping account waits for its trade workers before the thread exits
+    PIPELINE_STOP_TIMEOUT = 60
+
+    def __init__(self, account_cfg, cookies: RequestsCookieJar, steam: AdvancedSteamClient,
+                 buff: Buff163Client, scheduler: Union[FixedPollScheduler, AdaptivePollScheduler], notifiers=None,
+                 trade_store: Optional[TradeIdStore] = None, proxy_selector: Optional[ProxySelector] = None,
+                 session_refresher: Optional[SessionRefresher] = None):
+        Thread.__init__(self, name=account_cfg['username'], daemon=True)
+        BaseAccount.__init__(self, account_cfg, cookies, steam, buff, scheduler, notifiers=notifiers,
+                             trade_store=trade_store, proxy_selector=proxy_selector,
+                             session_refresher=session_refresher)
+        self.stopping = Event()
+        # (task, exception or None) of finished trade tasks, applied to the breakers by the poller thread
+        self.task_results: 'Queue[Tuple[TradeTask, Optional[Exception]]]' = Queue()
+        # ids which are already handled, for every trade task type
+        self.handled_ids = {
+            TaskType.ACCEPT: self.accepted_trade_ids,
+            TaskType.CONFIRM: self.confirmed_trade_ids,
+            TaskType.SEND_SELLER: self.known_ids,
+            TaskType.SEND_BUYER: self.known_ids
+        }
+        self.pipeline = TradePipeline(self.username, {
+            TaskType.ACCEPT: self.accept_trades,
+            TaskType.CONFIRM: self.confirm_trades,
+            TaskType.SEND_SELLER: lambda ids: self.send_trade_offers('seller', ids),
+            TaskType.SEND_BUYER: lambda ids: self.send_trade_offers('buyer', ids)
+        }, workers=self._account_cfg.get('trade_workers', self.TRADE_WORKERS), on_error=self.on_task_error,
+            on_success=self.on_task_success)
+        self._fetch_executor = ThreadPoolExecutor(
+            max_workers=self._account_cfg.get('max_concurrent_fetches', self.MAX_CONCURRENT_FETCHES),
+            thread_name_prefix=f'{self.username} fetch')
+
+    def login(self, force=False, steam_alive: Optional[bool] = None):
+        with request_priority(Priority.BACKGROUND):
+            self.steam.login(force=force, alive=steam_alive)
+            self.buff.login(force=force)
+
+    def login_side(self, side: Optional[str]):
+        with request_priority(Priority.BACKGROUND):
+            if side == BUFF:
+                try:
+                    self.buff.login()
+                    return
+
+                except Exception as e:
+                    # buff logs in through steam openid, which fails if the steam session expired too
+                    print(f'[{self.username}] Buff login failed ({e.__class__.__name__}), checking steam session')
+
+            self.steam.login()
+            if side != STEAM:
+                self.buff.login()
+
+    def relogin(self, side: Optional[str] = None):
+        # only the side which failed logs in again, both sides if it is unknown
+        try:
+            self.login_side(side)
+
+        except Exception:
+            RELOGINS_TOTAL.inc(account=self.username, side=side or 'all', status='error')
+            raise
+
+        RELOGINS_TOTAL.inc(account=self.username, side=side or 'all', status='ok')
+
+    def is_offer_finished(self, task_type: TaskType, tradeofferid: str) -> bool:
+        if self.trade_offers is None or task_type not in (TaskType.ACCEPT, TaskType.CONFIRM):
+            return False
+
+        expected_state = TradeOfferState.Active if task_type == TaskType.ACCEPT else TradeOfferState.ConfirmationNeed
+        state = self.trade_offers.get_skip_reason(tradeofferid, expected_state)
+        if state is None:
+            return False
+
+        print(f'[{self.username}] Skipping {task_type.value} of trade {tradeofferid} in state {state}')
+        self.handled_ids[task_type].add(tradeofferid)
+        return True
+
+    def submit(self, task_type: TaskType, ids: List[str]):
+        # handled ids are skipped here, ids which are queued or running are skipped by the pipeline
+        ids = [trade_id for trade_id in ids if trade_id not in self.handled_ids[task_type]]
+        ids = [trade_id for trade_id in ids if not self.is_offer_finished(task_type, trade_id)]
+        for trade_id in ids:
+            self.mark_seen(trade_id)
+
+        self.tick_actions += len(self.pipeline.submit(task_type, ids))
+
+    def on_task_error(self, task: TradeTask, exception: Exception):
+        # orders of the failed task are fetched and queued again on the next tick
+        self.notification_tracker.invalidate()
+        self.task_results.put((task, exception))
+
+    def on_task_success(self, task: TradeTask):
+        if self.action_breaker_keys:
+            self.task_results.put((task, None))
+
+    def check_task_results(self):
+        # a trade task which failed all attempts is raised on the poller thread like a failed tick, so it is
+        # classified, backs off the next ticks and logs in again. A successful task closes breakers of failed ones
+        exception = None
+        while True:
+            try:
+                _, task_exception = self.task_results.get_nowait()
+
+            except Empty:
+                break
+
+            if task_exception is not None:
+                exception = task_exception
+
+            elif exception is None:
+                for key in self.action_breaker_keys:
+                    self.breakers.breakers[key].record_success()
+
+                self.action_breaker_keys.clear()
+
+        if exception is not None:
+            self.action_breaker_keys.add(classify_error(exception).key)
+            raise exception
+
+    def accept_trade(self, tradeofferid: str):
+        if tradeofferid in self.accepted_trade_ids:
+            return
+
+        print(f'[{self.username}] Accepting trade offer')
+        with request_priority(Priority.TRADE):
+            self.steam.accept_trade_offer(tradeofferid)
+
+        self.on_trade_accepted(tradeofferid)
+
+    def accept_trades(self, tradeofferids: List[str]):
+        for tradeofferid in tradeofferids:
+            self.accept_trade(tradeofferid)
+
+    def confirm_trades(self, tradeofferids: List[str]):
+        tradeofferids = [tradeofferid for tradeofferid in tradeofferids if tradeofferid not in self.confirmed_trade_ids]
+        if len(tradeofferids) == 0:
+            return
+
+        with request_priority(Priority.TRADE):
+            confirmed = self.steam.confirm_transactions(tradeofferids)
+
+        self.on_trades_confirmed(tradeofferids, confirmed)
+
+    def send_trade_offers(self, role: str, ids: List[str]):
+        ids = [order_id for order_id in ids if order_id not in self.known_ids]
+        if len(ids) == 0:
+            return
+
+        print(f'[{self.username}] Sending trade offer to {"buyer" if role == "seller" else "seller"}')
+        with request_priority(Priority.TRADE):
+            self.buff.send_trade_offers(role, ids)
+
+        print(f'[{self.username}] Success')
+        self.on_offers_sent(ids)
+
+    def fetch_games(self, fetch: Callable[[str, int], List[Order]], counters: Dict[str, int]) -> List[List[Order]]:
+        games = [(game, count) for game, count in counters.items() if count != 0]
+        if len(games) <= 1:
+            return [fetch(game, count) for game, count in games]
+
+        return list(self._fetch_executor.map(lambda game_count: fetch(*game_count), games))
+
+    def get_orders_to_deliver(self, game: str, count: int) -> List[Order]:
+        orders = []
+        for page in self.buff.iter_items_to_deliver(game, self.buff.get_page_size(count)):
+            if self.add_orders_to_deliver(orders, page, count):
+                break
+
+        return orders
+
+    def get_orders_to_send_offer(self, game: str, count: int) -> List[Order]:
+        orders = []
+        for page in self.buff.iter_items_to_send_offer(game, self.buff.get_page_size(count)):
+            if self.add_orders_to_send_offer(orders, page, count):
+                break
+
+        return orders
+
+    def check_to_deliver(self, notifications):
+        games_data = self.fetch_games(self.get_orders_to_deliver, notifications['to_deliver_order'])
+        ids_to_confirm, ids_to_accept, ids_to_send_trade = self.sort_orders_to_deliver(games_data)
+        self.submit(TaskType.CONFIRM, ids_to_confirm)
+        self.submit(TaskType.ACCEPT, ids_to_accept)
+        self.submit(TaskType.SEND_SELLER, ids_to_send_trade)
+
+    def check_to_send_offer(self, notifications):
+        ids_to_send_trade = []
+        games_data = self.fetch_games(self.get_orders_to_send_offer, notifications['to_send_offer_order'])
+        for orders in games_data:
+            ids_to_send_trade.extend(order.id for order in orders)
+
+        self.submit(TaskType.SEND_BUYER, ids_to_send_trade)
+
+    def check_to_accept_offers(self, notifications):
+        if sum(notifications['to_accept_offer_order'].values()) > 0:
+            trades = self.buff.get_trades_to_accept()
+            self.submit(TaskType.ACCEPT, [trade.tradeofferid for trade in trades])
+
+    def run_check(self, check: Callable[[dict], None], notifications, category: str):
+        if not self.notification_tracker.should_check(notifications, category):
+            return
+
+        tick_actions = self.tick_actions
+        try:
+            check(notifications)
+
+        except Exception:
+            self.notification_tracker.invalidate(category)
+            raise
+
+        self.notification_tracker.mark_checked(notifications, category, self.tick_actions - tick_actions)
+
+    def is_busy(self, notifications) -> bool:
+        return self.pipeline.depth() > 0 or super().is_busy(notifications)
+
+    def mainloop(self):
+        while not self.stopping.is_set():
+            tick_start = self.start_tick()
+            self.check_task_results()
+            notifications = self.buff.get_notifications()
+            if self._account_cfg.get('process_sell_offers', True):
+                self.run_check(self.check_to_deliver, notifications, 'to_deliver_order')
+            
+            if self._account_cfg.get('process_buy_offers', True):
+                self.run_check(self.check_to_send_offer, notifications, 'to_send_offer_order')
+                self.run_check(self.check_to_accept_offers, notifications, 'to_accept_offer_order')
+
+            self.stopping.wait(self.finish_tick(tick_start, notifications))
+
+    def start_session_refresh(self, side: str):
+        Thread(target=self.refresh_session, args=(side,), name=f'{self.username} session refresh', daemon=True).start()
+
+    def refresh_session(self, side: str):
+        exception = None
+        try:
+            with request_priority(Priority.BACKGROUND):
+                if side == STEAM:
+                    self.steam.refresh_session()
+
+                else:
+                    self.buff.login(force=True)
+
+        except Exception as e:
+            exception = e
+
+        self.finish_session_refresh(side, exception)
+
+    def handle_exception(self, exception: Exception) -> float:
+        # returns how long to wait before the next tick
+        error, delay = self.record_exception(exception)
+        try:
+            if self.should_check_steam_session(error):
+                with request_priority(Priority.BACKGROUND):
+                    error = self.on_steam_session_check(error, self.steam.is_session_alive())
+
+            if error.kind == SESSION:
+                self.relogin(error.side)
+                return self.get_relogin_delay(error)
+
+        except Exception as e:
+            delay = self.record_login_failure(e, delay)
+
+        return delay
+
+    def stop(self):
+        # the account stops after the current tick, queued trades are still handled
+        self.stopping.set()
+
+    def run(self):
+        # the buff key is loaded before the first offer is sent
+        self.buff.load_encryptor()
+        self.pipeline.start()
+        self.stopping.wait(self.scheduler.start_delay())
+        while not self.stopping.is_set():
+            try:
+                self.mainloop()
+
+            except Exception as e:
+                delay = self.handle_exception(e)
+                print(f'[{self.username}] Retrying in {delay:.0f}s')
+                self.stopping.wait(delay)
+
+        self.pipeline.stop()
+        self._fetch_executor.shutdown(wait=False)
+        self.pipeline.join(self.PIPELINE_STOP_TIMEOUT)
+        if self.pipeline.is_alive():
+            print(f'[{self.username}] Stopped, trade workers are still running')
+
+        else:
+            print(f'[{self.username}] Stopped')
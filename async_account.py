@@ -0,0 +1,362 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+from functools import partial
+from threading import Event, Thread
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Union
+from requests.cookies import RequestsCookieJar
+from steampy.models import TradeOfferState
+
+from account import BaseAccount
+from circuit_breaker import BUFF, SESSION, STEAM
+from metrics import RELOGINS_TOTAL
+from proxy_pool import ProxySelector
+from rate_limiter import Priority, request_priority
+from scheduler import AdaptivePollScheduler, FixedPollScheduler
+from session_refresher import SessionRefresher
+from steam import AdvancedSteamClient
+from trade_store import TradeIdSet, TradeIdStore
+from buff163.async_client import AsyncBuff163Client
+from buff163.models import Order
+
+
+class AsyncAccount(BaseAccount):
+    def __init__(self, account_cfg, cookies: RequestsCookieJar, steam: AdvancedSteamClient,
+                 buff: AsyncBuff163Client, scheduler: Union[FixedPollScheduler, AdaptivePollScheduler], notifiers=None,
+                 trade_store: Optional[TradeIdStore] = None, proxy_selector: Optional[ProxySelector] = None,
+                 session_refresher: Optional[SessionRefresher] = None):
+        super().__init__(account_cfg, cookies, steam, buff, scheduler, notifiers=notifiers, trade_store=trade_store,
+                         proxy_selector=proxy_selector, session_refresher=session_refresher)
+        self._refresh_task: Optional[asyncio.Task] = None
+        self.semaphore: asyncio.Semaphore = None
+        # created on the runtime's event loop when the account starts
+        self.stopping: Optional[asyncio.Event] = None
+        self.stop_requested = False
+        # set by the runtime when the account's task has ended
+        self.finished = Event()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self.max_concurrent_fetches = self._account_cfg.get('max_concurrent_fetches', self.MAX_CONCURRENT_FETCHES)
+
+    async def run_blocking(self, func, *args):
+        # steam client is synchronous, run it in the runtime's bounded executor.
+        # The context is copied so the request priority reaches the rate limiter
+        context = contextvars.copy_context()
+        async with self.semaphore:
+            return await asyncio.get_running_loop().run_in_executor(None, partial(context.run, func, *args))
+
+    async def login(self, force=False):
+        with request_priority(Priority.BACKGROUND):
+            await self.run_blocking(self.steam.login, force)
+            await self.buff.login(force=force)
+
+    async def login_side(self, side: Optional[str]):
+        with request_priority(Priority.BACKGROUND):
+            if side == BUFF:
+                try:
+                    await self.buff.login()
+                    return
+
+                except Exception as e:
+                    # buff logs in through steam openid, which fails if the steam session expired too
+                    print(f'[{self.username}] Buff login failed ({e.__class__.__name__}), checking steam session')
+
+            await self.run_blocking(self.steam.login)
+            if side != STEAM:
+                await self.buff.login()
+
+    async def relogin(self, side: Optional[str] = None):
+        # only the side which failed logs in again, both sides if it is unknown
+        try:
+            await self.login_side(side)
+
+        except Exception:
+            RELOGINS_TOTAL.inc(account=self.username, side=side or 'all', status='error')
+            raise
+
+        RELOGINS_TOTAL.inc(account=self.username, side=side or 'all', status='ok')
+
+    async def is_offer_finished(self, tradeofferid: str, expected_state: TradeOfferState,
+                                handled_ids: TradeIdSet) -> bool:
+        if self.trade_offers is None:
+            return False
+
+        if self.trade_offers.stale:
+            await self.run_blocking(self.trade_offers.refresh)
+
+        state = self.trade_offers.get_skip_reason(tradeofferid, expected_state)
+        if state is None:
+            return False
+
+        print(f'[{self.username}] Skipping trade {tradeofferid} in state {state}')
+        handled_ids.add(tradeofferid)
+        return True
+
+    async def accept_trade(self, tradeofferid: str):
+        if tradeofferid in self.accepted_trade_ids:
+            return
+
+        if await self.is_offer_finished(tradeofferid, TradeOfferState.Active, self.accepted_trade_ids):
+            return
+
+        self.mark_seen(tradeofferid)
+        print(f'[{self.username}] Accepting trade offer')
+        with request_priority(Priority.TRADE):
+            await self.run_blocking(self.steam.accept_trade_offer, tradeofferid)
+
+        self.tick_actions += 1
+        self.on_trade_accepted(tradeofferid)
+
+    async def confirm_trades(self, tradeofferids: List[str]):
+        tradeofferids = [tradeofferid for tradeofferid in tradeofferids if tradeofferid not in self.confirmed_trade_ids]
+        tradeofferids = [tradeofferid for tradeofferid in tradeofferids if not await self.is_offer_finished(
+            tradeofferid, TradeOfferState.ConfirmationNeed, self.confirmed_trade_ids)]
+        if len(tradeofferids) == 0:
+            return
+
+        for tradeofferid in tradeofferids:
+            self.mark_seen(tradeofferid)
+
+        with request_priority(Priority.TRADE):
+            confirmed = await self.run_blocking(self.steam.confirm_transactions, tradeofferids)
+
+        self.tick_actions += len(confirmed)
+        self.on_trades_confirmed(tradeofferids, confirmed)
+
+    async def fetch_games(self, fetch: Callable[[str, int], Awaitable[List[Order]]],
+                          counters: Dict[str, int]) -> List[List[Order]]:
+        fetch_semaphore = asyncio.Semaphore(self.max_concurrent_fetches)
+
+        async def fetch_game(game: str, count: int):
+            async with fetch_semaphore:
+                return await fetch(game, count)
+
+        return await asyncio.gather(*(fetch_game(game, count) for game, count in counters.items() if count != 0))
+
+    async def get_orders_to_deliver(self, game: str, count: int) -> List[Order]:
+        orders = []
+        async for page in self.buff.iter_items_to_deliver(game, self.buff.get_page_size(count)):
+            if self.add_orders_to_deliver(orders, page, count):
+                break
+
+        return orders
+
+    async def get_orders_to_send_offer(self, game: str, count: int) -> List[Order]:
+        orders = []
+        async for page in self.buff.iter_items_to_send_offer(game, self.buff.get_page_size(count)):
+            if self.add_orders_to_send_offer(orders, page, count):
+                break
+
+        return orders
+
+    async def send_trade_offers(self, role: str, ids: List[str]):
+        if len(ids) == 0:
+            return
+
+        for order_id in ids:
+            self.mark_seen(order_id)
+
+        print(f'[{self.username}] Sending trade offer to {"buyer" if role == "seller" else "seller"}')
+        with request_priority(Priority.TRADE):
+            await self.buff.send_trade_offers(role, ids)
+
+        print(f'[{self.username}] Success')
+        self.tick_actions += len(ids)
+        self.on_offers_sent(ids)
+
+    async def check_to_deliver(self, notifications):
+        games_data = await self.fetch_games(self.get_orders_to_deliver, notifications['to_deliver_order'])
+        ids_to_confirm, ids_to_accept, ids_to_send_trade = self.sort_orders_to_deliver(games_data)
+        for tradeofferid in ids_to_accept:
+            await self.accept_trade(tradeofferid)
+
+        await self.send_trade_offers('seller', ids_to_send_trade)
+        await self.confirm_trades(ids_to_confirm)
+
+    async def check_to_send_offer(self, notifications):
+        games_data = await self.fetch_games(self.get_orders_to_send_offer, notifications['to_send_offer_order'])
+        await self.send_trade_offers('buyer', [order.id for orders in games_data for order in orders])
+
+    async def check_to_accept_offers(self, notifications):
+        if sum(notifications['to_accept_offer_order'].values()) > 0:
+            trades = await self.buff.get_trades_to_accept()
+            for trade in trades:
+                await self.accept_trade(trade.tradeofferid)
+
+    async def run_check(self, check: Callable[[dict], Awaitable[None]], notifications, category: str):
+        if not self.notification_tracker.should_check(notifications, category):
+            return
+
+        tick_actions = self.tick_actions
+        try:
+            await check(notifications)
+
+        except Exception:
+            self.notification_tracker.invalidate(category)
+            raise
+
+        self.notification_tracker.mark_checked(notifications, category, self.tick_actions - tick_actions)
+
+    async def mainloop(self):
+        while not self.stopping.is_set():
+            tick_start = self.start_tick()
+            notifications = await self.buff.get_notifications()
+            if self._account_cfg.get('process_sell_offers', True):
+                await self.run_check(self.check_to_deliver, notifications, 'to_deliver_order')
+
+            if self._account_cfg.get('process_buy_offers', True):
+                await self.run_check(self.check_to_send_offer, notifications, 'to_send_offer_order')
+                await self.run_check(self.check_to_accept_offers, notifications, 'to_accept_offer_order')
+
+            await self.sleep(self.finish_tick(tick_start, notifications))
+
+    def start_session_refresh(self, side: str):
+        self._refresh_task = asyncio.ensure_future(self.refresh_session(side))
+
+    async def refresh_session(self, side: str):
+        exception = None
+        try:
+            with request_priority(Priority.BACKGROUND):
+                if side == STEAM:
+                    await self.run_blocking(self.steam.refresh_session)
+
+                else:
+                    await self.buff.login(force=True)
+
+        except Exception as e:
+            exception = e
+
+        self.finish_session_refresh(side, exception)
+
+    async def handle_exception(self, exception: Exception) -> float:
+        # returns how long to wait before the next tick
+        error, delay = self.record_exception(exception)
+        try:
+            if self.should_check_steam_session(error):
+                with request_priority(Priority.BACKGROUND):
+                    error = self.on_steam_session_check(error, await self.run_blocking(self.steam.is_session_alive))
+
+            if error.kind == SESSION:
+                await self.relogin(error.side)
+                return self.get_relogin_delay(error)
+
+        except Exception as e:
+            delay = self.record_login_failure(e, delay)
+
+        return delay
+
+    async def sleep(self, delay: float):
+        # returns early if the account is stopped
+        try:
+            await asyncio.wait_for(self.stopping.wait(), delay)
+
+        except asyncio.TimeoutError:
+            pass
+
+    def set_proxies(self, proxy_selector: Optional[ProxySelector], proxies: Dict[str, str]):
+        # called by the config reload on the main thread, the aiohttp sessions belong to the account's loop
+        if self._loop is None:
+            super().set_proxies(proxy_selector, proxies)
+
+        else:
+            self._loop.call_soon_threadsafe(super().set_proxies, proxy_selector, proxies)
+
+    def stop(self):
+        # can be called from any thread, the account stops after the current tick
+        self.stop_requested = True
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self.stopping.set)
+
+    async def run(self):
+        self.stopping = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+        if self.stop_requested:
+            self.stopping.set()
+
+        # the buff key is loaded before the first offer is sent
+        self.buff.load_encryptor()
+
+        await self.sleep(self.scheduler.start_delay())
+        while not self.stopping.is_set():
+            try:
+                await self.mainloop()
+
+            except asyncio.CancelledError:
+                raise
+
+            except Exception as e:
+                delay = await self.handle_exception(e)
+                print(f'[{self.username}] Retrying in {delay:.0f}s')
+                await self.sleep(delay)
+
+        print(f'[{self.username}] Stopped')
+
+
+class AsyncAccountRunner(Thread):
+    THREAD_NAME = 'Asyncio accounts'
+
+    def __init__(self, accounts: List[AsyncAccount], max_concurrent_requests: int,
+                 login_check: bool = True, force_login: bool = False):
+        super().__init__(name=self.THREAD_NAME, daemon=True)
+        self.accounts = accounts
+        self.max_concurrent_requests = max_concurrent_requests
+        self.login_check = login_check
+        self.force_login = force_login
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.semaphore: Optional[asyncio.Semaphore] = None
+        self.tasks: Set[asyncio.Future] = set()
+        self.started = Event()
+
+    async def start_account(self, account: AsyncAccount):
+        if self.login_check:
+            try:
+                await account.login(force=self.force_login)
+
+            except Exception as e:
+                # the account's own retry loop takes over from here
+                print(f'[{account.username}] Failed to login: {e.__class__.__name__}: {e}')
+                account.notify_exception(e)
+
+        try:
+            await account.run()
+
+        finally:
+            await account.buff.close()
+            self.accounts.remove(account)
+            account.finished.set()
+
+    def add_account(self, account: AsyncAccount):
+        # can be called from any thread
+        self.started.wait()
+        self.accounts.append(account)
+        self.loop.call_soon_threadsafe(self.create_task, account)
+
+    def create_task(self, account: AsyncAccount):
+        account.semaphore = self.semaphore
+        account.buff.semaphore = self.semaphore
+        self.tasks.add(asyncio.ensure_future(self.start_account(account)))
+
+    async def main(self):
+        self.loop = asyncio.get_running_loop()
+        self.loop.set_default_executor(ThreadPoolExecutor(max_workers=self.max_concurrent_requests))
+        self.semaphore = asyncio.Semaphore(self.max_concurrent_requests)
+        for account in self.accounts:
+            self.create_task(account)
+
+        self.started.set()
+        # the runtime keeps running when every account is stopped, so accounts can be added later
+        forever = self.loop.create_future()
+        try:
+            while True:
+                done, _ = await asyncio.wait(self.tasks | {forever}, return_when=asyncio.FIRST_COMPLETED)
+                self.tasks.difference_update(done)
+                for task in done:
+                    task.result()
+
+        finally:
+            for account in list(self.accounts):
+                await account.buff.close()
+
+            await AsyncBuff163Client.close_connectors()
+
+    def run(self):
+        asyncio.run(self.main())
@@ -0,0 +1,336 @@
+import json
+import random
+from argparse import ArgumentParser
+from http.cookies import SimpleCookie
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from time import sleep, time
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+# kinds of simulated orders
+SELL_ACCEPT = 'sell_accept'  # buyer sent an offer, the seller accepts it
+SELL_SEND = 'sell_send'  # the seller sends an offer and confirms it
+BUY_SEND = 'buy_send'  # the buyer asks the seller to send an offer
+BUY_ACCEPT = 'buy_accept'  # the seller sent an offer, the buyer accepts it
+ORDER_KINDS = (SELL_ACCEPT, SELL_SEND, BUY_SEND, BUY_ACCEPT)
+
+GAME = 'csgo'
+PARTNER_STEAMID = '76561198000000000'
+
+
+class MockOrder:
+    __slots__ = ('id', 'account', 'kind', 'created', 'tradeofferid', 'offer_state', 'done')
+
+    def __init__(self, order_id: str, account: str, kind: str, created: float):
+        self.id = order_id
+        self.account = account
+        self.kind = kind
+        self.created = created
+        self.tradeofferid: Optional[str] = None
+        # steam trade offer state, 2 active, 3 accepted, 9 needs confirmation
+        self.offer_state = 0
+        self.done: Optional[float] = None
+
+
+class MockState:
+    # Orders of all simulated accounts, created at a fixed rate per account
+    def __init__(self, accounts: List[str], order_rate: float, duration: float, mix: Dict[str, float],
+                 seed: int = 0):
+        self.accounts = accounts
+        self.order_rate = order_rate
+        self.duration = duration
+        self.mix = mix
+        self.random = random.Random(seed)
+        self.orders: Dict[str, MockOrder] = {}
+        self.offers: Dict[str, MockOrder] = {}
+        self.requests: Dict[str, int] = {}
+        self.errors = 0
+        # account -> time its orders last changed, reported as updated_at
+        self.updated: Dict[str, int] = {}
+        self.next_id = 1
+        self.started = time()
+        self.lock = Lock()
+
+    def new_id(self) -> str:
+        self.next_id += 1
+        return str(1000000 + self.next_id)
+
+    def add_order(self, account: str, kind: str):
+        with self.lock:
+            order = MockOrder(self.new_id(), account, kind, time())
+            if kind in (SELL_ACCEPT, BUY_ACCEPT):
+                order.tradeofferid = self.new_id()
+                order.offer_state = 2
+                self.offers[order.tradeofferid] = order
+
+            self.orders[order.id] = order
+            self.updated[account] = int(time() * 1000)
+
+    def generate(self):
+        kinds = list(self.mix)
+        weights = [self.mix[kind] for kind in kinds]
+        while time() - self.started < self.duration:
+            for account in self.accounts:
+                if self.random.random() < self.order_rate:
+                    self.add_order(account, self.random.choices(kinds, weights)[0])
+
+            sleep(1)
+
+    def pending(self, account: str, *kinds: str) -> List[MockOrder]:
+        with self.lock:
+            return [order for order in self.orders.values()
+                    if order.account == account and order.kind in kinds and order.done is None]
+
+    def finish(self, order: MockOrder, offer_state: int):
+        order.offer_state = offer_state
+        self.updated[order.account] = int(time() * 1000)
+        if order.done is None:
+            order.done = time()
+
+    def stats(self) -> dict:
+        with self.lock:
+            orders = list(self.orders.values())
+            return {
+                'requests': dict(self.requests),
+                'errors': self.errors,
+                'created': len(orders),
+                'done': sum(order.done is not None for order in orders),
+                'latencies': [(order.kind, order.done - order.created) for order in orders if order.done is not None],
+                'elapsed': time() - self.started
+            }
+
+
+def buff_ok(data) -> dict:
+    return {'code': 'OK', 'data': data, 'error': None}
+
+
+def make_handler(state: MockState, latency: float, jitter: float, error_rate: float):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, data, status: int = 200):
+            body = json.dumps(data).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def send_text(self, text: str, status: int = 200):
+            body = text.encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'text/html')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def get_account(self) -> str:
+            cookie = SimpleCookie(self.headers.get('Cookie', ''))
+            return cookie['bench_account'].value if 'bench_account' in cookie else ''
+
+        def read_body(self) -> bytes:
+            length = int(self.headers.get('Content-Length', 0))
+            return self.rfile.read(length) if length else b''
+
+        def handle_request(self, method: str):
+            # requests are rewritten to /<original host>/<original path>
+            url = urlparse(self.path)
+            if url.path == '/_bench/stats':
+                self.send_json(state.stats())
+                return
+
+            _, host, path = url.path.split('/', 2)
+            path = '/' + path
+            query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+            body = self.read_body()
+            endpoint = host + path
+            if path.startswith('/tradeoffer/'):
+                endpoint = host + ('/tradeoffer/accept' if path.endswith('/accept') else '/tradeoffer')
+
+            with state.lock:
+                state.requests[endpoint] = state.requests.get(endpoint, 0) + 1
+
+            if latency or jitter:
+                sleep(latency + random.uniform(0, jitter))
+
+            if error_rate and random.random() < error_rate:
+                with state.lock:
+                    state.errors += 1
+
+                self.send_json({'error': 'injected'}, 503)
+                return
+
+            handler = ROUTES.get((method, host, path), None)
+            if handler is None and path.startswith('/tradeoffer/'):
+                parts = path.split('/')
+                query['tradeofferid'] = parts[2]
+                handler = accept_offer if len(parts) > 3 and parts[3] == 'accept' else trade_offer_page
+
+            if handler is None:
+                self.send_json({'error': 'not found'}, 404)
+                return
+
+            handler(self, self.get_account(), query, body)
+
+        def do_GET(self):
+            self.handle_request('GET')
+
+        def do_POST(self):
+            self.handle_request('POST')
+
+    def notifications(handler, account, query, body):
+        to_deliver = len(state.pending(account, SELL_ACCEPT, SELL_SEND))
+        to_send = len(state.pending(account, BUY_SEND))
+        to_accept = len(state.pending(account, BUY_ACCEPT))
+        handler.send_json(buff_ok({
+            'to_deliver_order': {GAME: to_deliver},
+            'to_send_offer_order': {GAME: to_send},
+            'to_accept_offer_order': {GAME: to_accept},
+            'updated_at': {GAME: state.updated.get(account, 0)}
+        }))
+
+    def get_page(query, items: list) -> list:
+        page_num = int(query.get('page_num', 1))
+        page_size = int(query.get('page_size', 10))
+        return items[(page_num - 1) * page_size:page_num * page_size]
+
+    def to_deliver(handler, account, query, body):
+        items = [{
+            'id': order.id,
+            'tradeofferid': order.tradeofferid,
+            'is_seller_asked_to_send_offer': order.kind == SELL_SEND,
+            'type': 1,
+            'state': 'DELIVERING' if order.offer_state == 9 else 'TO_DELIVER',
+            'has_sent_offer': order.tradeofferid is not None
+        } for order in state.pending(account, SELL_ACCEPT, SELL_SEND)]
+        handler.send_json(buff_ok({'items': get_page(query, items)}))
+
+    def buy_history(handler, account, query, body):
+        items = [{
+            'id': order.id,
+            'is_seller_asked_to_send_offer': False,
+            'has_sent_offer': False
+        } for order in reversed(state.pending(account, BUY_SEND))]
+        handler.send_json(buff_ok({'items': get_page(query, items)}))
+
+    def steam_trade(handler, account, query, body):
+        handler.send_json(buff_ok([{'tradeofferid': order.tradeofferid}
+                                   for order in state.pending(account, BUY_ACCEPT)]))
+
+    def send_offer(role: str):
+        def handle(handler, account, query, body):
+            ids = json.loads(body)['bill_orders']
+            with state.lock:
+                for order_id in ids:
+                    order = state.orders.get(order_id, None)
+                    if order is None:
+                        continue
+
+                    if role == 'buyer':
+                        state.finish(order, 3)
+
+                    elif order.tradeofferid is None:
+                        order.tradeofferid = state.new_id()
+                        order.offer_state = 9
+                        state.updated[account] = int(time() * 1000)
+                        state.offers[order.tradeofferid] = order
+
+            handler.send_json(buff_ok({}))
+
+        return handle
+
+    def get_trade_offer(handler, account, query, body):
+        order = state.offers.get(query.get('tradeofferid', ''), None)
+        offer_state = order.offer_state if order is not None else 1
+        handler.send_json({'response': {'offer': {'tradeofferid': query.get('tradeofferid', ''),
+                                                  'trade_offer_state': offer_state}}})
+
+    def get_trade_offers(handler, account, query, body):
+        with state.lock:
+            offers = [order for order in state.offers.values() if order.account == account]
+
+        sent = [{'tradeofferid': order.tradeofferid, 'trade_offer_state': order.offer_state}
+                for order in offers if order.kind == SELL_SEND]
+        received = [{'tradeofferid': order.tradeofferid, 'trade_offer_state': order.offer_state}
+                    for order in offers if order.kind != SELL_SEND]
+        handler.send_json({'response': {'trade_offers_sent': sent, 'trade_offers_received': received}})
+
+    def trade_offer_page(handler, account, query, body):
+        handler.send_text(f"<script>var g_ulTradePartnerSteamID = '{PARTNER_STEAMID}';</script>")
+
+    def accept_offer(handler, account, query, body):
+        order = state.offers.get(query['tradeofferid'], None)
+        if order is None or order.offer_state != 2:
+            handler.send_json({'strError': 'Invalid offer'}, 500)
+            return
+
+        with state.lock:
+            state.finish(order, 3)
+
+        handler.send_json({'tradeid': state.new_id()})
+
+    def confirmations(handler, account, query, body):
+        with state.lock:
+            conf = [{'id': order.tradeofferid, 'nonce': 'n' + order.tradeofferid, 'creator_id': order.tradeofferid,
+                     'type': 2} for order in state.offers.values()
+                    if order.account == account and order.offer_state == 9]
+
+        handler.send_json({'success': True, 'conf': conf})
+
+    def confirm(ids: List[str]):
+        with state.lock:
+            for tradeofferid in ids:
+                order = state.offers.get(tradeofferid, None)
+                if order is not None and order.offer_state == 9:
+                    state.finish(order, 2)
+
+    def multi_confirm(handler, account, query, body):
+        confirm(parse_qs(body.decode('utf-8')).get('cid[]', []))
+        handler.send_json({'success': True})
+
+    def single_confirm(handler, account, query, body):
+        confirm([query.get('cid', '')])
+        handler.send_json({'success': True})
+
+    ROUTES = {
+        ('GET', 'buff.163.com', '/api/message/notification'): notifications,
+        ('GET', 'buff.163.com', '/api/market/sell_order/to_deliver'): to_deliver,
+        ('GET', 'buff.163.com', '/api/market/buy_order/history'): buy_history,
+        ('GET', 'buff.163.com', '/api/market/steam_trade'): steam_trade,
+        ('POST', 'buff.163.com', '/api/market/manual_plus/seller_send_offer'): send_offer('seller'),
+        ('POST', 'buff.163.com', '/api/market/manual_plus/buyer_send_offer'): send_offer('buyer'),
+        ('GET', 'api.steampowered.com', '/IEconService/GetTradeOffer/v1'): get_trade_offer,
+        ('GET', 'api.steampowered.com', '/IEconService/GetTradeOffers/v1'): get_trade_offers,
+        ('GET', 'steamcommunity.com', '/mobileconf/getlist'): confirmations,
+        ('POST', 'steamcommunity.com', '/mobileconf/multiajaxop'): multi_confirm,
+        ('GET', 'steamcommunity.com', '/mobileconf/ajaxop'): single_confirm,
+    }
+
+    return Handler
+
+
+def serve(port: int, accounts: List[str], order_rate: float, duration: float, mix: Dict[str, float],
+          latency: float = 0, jitter: float = 0, error_rate: float = 0, seed: int = 0):
+    state = MockState(accounts, order_rate, duration, mix, seed)
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(state, latency, jitter, error_rate))
+    server.daemon_threads = True
+    Thread(target=state.generate, name='Order generator', daemon=True).start()
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Local stand-in for the buff and steam endpoints used by the accounts')
+    parser.add_argument('--port', default=8163, type=int)
+    parser.add_argument('--accounts', default=10, type=int, help='Accounts are named bench0, bench1, ...')
+    parser.add_argument('--order-rate', default=0.1, type=float, help='Orders per account per second')
+    parser.add_argument('--duration', default=60, type=float, help='Seconds during which orders are created')
+    parser.add_argument('--latency', default=0, type=float, help='Delay of every response, in seconds')
+    parser.add_argument('--jitter', default=0, type=float, help='Random extra delay, in seconds')
+    parser.add_argument('--error-rate', default=0, type=float, help='Share of requests failed with code 503')
+    args = parser.parse_args()
+    serve(args.port, [f'bench{i}' for i in range(args.accounts)], args.order_rate, args.duration,
+          {kind: 1 for kind in ORDER_KINDS}, args.latency, args.jitter, args.error_rate)
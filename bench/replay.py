@@ -0,0 +1,260 @@
+import contextlib
+import json
+import multiprocessing
+import os
+import socket
+import sys
+from argparse import ArgumentParser
+from time import perf_counter, process_time, sleep
+from typing import Dict, List
+from urllib.parse import urlsplit
+from urllib.request import urlopen
+
+# the benchmark is run from the repository root with python -m bench.replay
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from account import Account
+from bench.mock_server import BUY_ACCEPT, BUY_SEND, ORDER_KINDS, SELL_ACCEPT, SELL_SEND, serve
+from buff163.client import Buff163Client
+from cookie_manager import TrackedCookieJar
+from http_pool import HTTPPool, PooledHTTPAdapter
+from metrics import get_max_rss
+from rate_limiter import RateLimiter
+from scheduler import AdaptivePollScheduler, FixedPollScheduler
+from steam import AdvancedSteamClient
+
+SCENARIOS = {
+    'smoke': {'accounts': 2, 'duration': 10, 'order_rate': 0.5},
+    'steady': {'accounts': 50, 'duration': 60, 'order_rate': 0.05},
+    'burst': {'accounts': 20, 'duration': 20, 'order_rate': 1, 'mix': {SELL_SEND: 3, SELL_ACCEPT: 1}},
+    'sellers': {'accounts': 50, 'duration': 60, 'order_rate': 0.1, 'mix': {SELL_SEND: 1, SELL_ACCEPT: 1}},
+    'buyers': {'accounts': 50, 'duration': 60, 'order_rate': 0.1, 'mix': {BUY_SEND: 1, BUY_ACCEPT: 1}},
+    'flaky': {'accounts': 20, 'duration': 60, 'order_rate': 0.1, 'latency': 0.05, 'jitter': 0.2,
+              'error_rate': 0.05},
+}
+
+DEFAULTS = {
+    'accounts': 10,
+    'duration': 30,
+    'order_rate': 0.1,
+    'mix': {kind: 1 for kind in ORDER_KINDS},
+    'latency': 0,
+    'jitter': 0,
+    'error_rate': 0,
+    'refresh_period': 2,
+    'adaptive_polling': False,
+    'drain_timeout': 60,
+    'rate_limits': None
+}
+
+STEAM_COOKIES = (
+    ('steamLoginSecure', 'store.steampowered.com'),
+    ('steamLoginSecure', 'steamcommunity.com'),
+    ('steamRefresh_steam', 'login.steampowered.com'),
+    ('sessionid', 'steamcommunity.com'),
+    ('steamCountry', 'steamcommunity.com'),
+)
+
+
+class ReplayAdapter(PooledHTTPAdapter):
+    # Sends every request to the mock server as /<host>/<path>
+    def __init__(self, base_url: str, **kwargs):
+        self.base_url = base_url
+        super().__init__(**kwargs)
+
+    def send(self, request, *args, **kwargs):
+        url = urlsplit(request.url)
+        request.url = f'{self.base_url}/{url.hostname}{url.path}' + (f'?{url.query}' if url.query else '')
+        return super().send(request, *args, **kwargs)
+
+
+class ReplayHTTPPool(HTTPPool):
+    def __init__(self, base_url: str, **kwargs):
+        super().__init__(**kwargs)
+        self.base_url = base_url
+
+    def create_adapter(self, retry_gets: bool) -> PooledHTTPAdapter:
+        adapter = super().create_adapter(retry_gets)
+        return ReplayAdapter(self.base_url, rate_limiter=self.rate_limiter, proxy_health=self.proxy_health,
+                             pool_connections=self.pool_connections,
+                             pool_maxsize=self.pool_maxsize, max_retries=adapter.max_retries)
+
+
+class ReplayAccount(Account):
+    # sessions of the mock server never expire, failed ticks are retried quickly
+    BACKOFF_BASE = 0.5
+    BACKOFF_MAX = 5
+
+    def login_side(self, side):
+        pass
+
+
+def get_free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_server(base_url: str, timeout: float = 10):
+    for _ in range(int(timeout * 10)):
+        try:
+            get_stats(base_url)
+            return
+
+        except OSError:
+            sleep(0.1)
+
+    raise TimeoutError('Mock server did not start')
+
+
+def get_stats(base_url: str) -> dict:
+    with urlopen(f'{base_url}/_bench/stats') as resp:
+        return json.loads(resp.read())
+
+
+def create_account(index: int, http_pool: HTTPPool, scenario: dict) -> ReplayAccount:
+    username = f'bench{index}'
+    account_cfg = {
+        'username': username,
+        'password': 'bench',
+        'api_key': 'bench',
+        'steamguard': {
+            'shared_secret': 'YmVuY2hzaGFyZWRzZWNyZXQ=',
+            'identity_secret': 'YmVuY2hpZGVudGl0eXNlY3JldA==',
+            'steamid': str(76561198100000000 + index)
+        }
+    }
+    cookie_jar = TrackedCookieJar()
+    for name, domain in STEAM_COOKIES:
+        cookie_jar.set(name, f'{username}-{name}', domain=domain)
+
+    # the mock server tells accounts apart by this cookie
+    cookie_jar.set('bench_account', username)
+    steam = AdvancedSteamClient(account_cfg, cookie_jar, http_pool=http_pool)
+    steam._access_token = 'bench'
+    buff = Buff163Client(account_cfg, cookie_jar, http_pool=http_pool)
+    if scenario['adaptive_polling']:
+        scheduler = AdaptivePollScheduler(scenario['refresh_period'], scenario['refresh_period'] * 10)
+
+    else:
+        scheduler = FixedPollScheduler(scenario['refresh_period'])
+
+    return ReplayAccount(account_cfg, cookie_jar, steam, buff, scheduler=scheduler)
+
+
+def percentile(values: List[float], share: float) -> float:
+    if len(values) == 0:
+        return float('nan')
+
+    ordered = sorted(values)
+    return ordered[min(int(share * len(ordered)), len(ordered) - 1)]
+
+
+def make_report(scenario_name: str, scenario: dict, stats: dict, cpu: float, wall: float) -> dict:
+    latencies: Dict[str, List[float]] = {}
+    for kind, latency in stats['latencies']:
+        latencies.setdefault(kind, []).append(latency)
+
+    all_latencies = [latency for _, latency in stats['latencies']]
+    requests = sum(stats['requests'].values())
+    return {
+        'scenario': scenario_name,
+        'accounts': scenario['accounts'],
+        'orders_created': stats['created'],
+        'orders_done': stats['done'],
+        'throughput': stats['done'] / wall,
+        'time_to_action': {kind: {'p50': percentile(values, 0.5), 'p90': percentile(values, 0.9),
+                                  'p99': percentile(values, 0.99), 'max': max(values)}
+                           for kind, values in sorted(latencies.items())},
+        'time_to_action_p50': percentile(all_latencies, 0.5),
+        'time_to_action_p99': percentile(all_latencies, 0.99),
+        'requests': requests,
+        'requests_per_trade': requests / stats['done'] if stats['done'] else float('nan'),
+        'requests_by_endpoint': dict(sorted(stats['requests'].items())),
+        'injected_errors': stats['errors'],
+        'cpu_seconds': cpu,
+        'cpu_share': cpu / wall,
+        'max_rss_mb': get_max_rss(),
+        'wall_seconds': wall
+    }
+
+
+def print_report(report: dict):
+    print(f'Scenario {report["scenario"]}: {report["accounts"]} accounts, {report["wall_seconds"]:.1f}s')
+    print(f'Orders: {report["orders_done"]}/{report["orders_created"]} done, '
+          f'{report["throughput"]:.2f} trades/s')
+    for kind, values in report['time_to_action'].items():
+        print(f'Time to action {kind}: p50 {values["p50"]:.2f}s, p90 {values["p90"]:.2f}s, '
+              f'p99 {values["p99"]:.2f}s, max {values["max"]:.2f}s')
+
+    print(f'Requests: {report["requests"]} ({report["requests_per_trade"]:.1f} per trade), '
+          f'{report["injected_errors"]} injected errors')
+    for endpoint, count in report['requests_by_endpoint'].items():
+        print(f'  {endpoint}: {count}')
+
+    max_rss = f'{report["max_rss_mb"]:.0f}MB' if report['max_rss_mb'] is not None else 'n/a'
+    print(f'CPU: {report["cpu_seconds"]:.2f}s ({report["cpu_share"]:.0%} of one core), max RSS {max_rss}')
+
+
+def run(scenario_name: str, scenario: dict, verbose: bool = False) -> dict:
+    port = get_free_port()
+    base_url = f'http://127.0.0.1:{port}'
+    usernames = [f'bench{i}' for i in range(scenario['accounts'])]
+    # the server runs in its own process, so its CPU time is not counted
+    server = multiprocessing.Process(target=serve, daemon=True, args=(
+        port, usernames, scenario['order_rate'], scenario['duration'], scenario['mix'],
+        scenario['latency'], scenario['jitter'], scenario['error_rate']))
+    server.start()
+    wait_for_server(base_url)
+
+    rate_limiter = RateLimiter(scenario['rate_limits'])
+    http_pool = ReplayHTTPPool(base_url, rate_limiter=rate_limiter)
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(open(os.devnull, 'w'))
+    with output:
+        accounts = [create_account(i, http_pool, scenario) for i in range(scenario['accounts'])]
+        start_wall = perf_counter()
+        start_cpu = process_time()
+        for account in accounts:
+            account.start()
+
+        sleep(scenario['duration'])
+        # orders created at the end of the run are given time to be handled
+        drain_deadline = perf_counter() + scenario['drain_timeout']
+        stats = get_stats(base_url)
+        while stats['done'] < stats['created'] and perf_counter() < drain_deadline:
+            sleep(0.5)
+            stats = get_stats(base_url)
+
+        cpu = process_time() - start_cpu
+        wall = perf_counter() - start_wall
+
+    server.terminate()
+    return make_report(scenario_name, scenario, stats, cpu, wall)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Replay simulated orders of many accounts against a local mock server')
+    parser.add_argument('scenario', nargs='?', default='smoke', choices=sorted(SCENARIOS))
+    parser.add_argument('--accounts', type=int, help='Number of simulated accounts')
+    parser.add_argument('--duration', type=float, help='Seconds during which orders are created')
+    parser.add_argument('--order-rate', type=float, help='Orders per account per second')
+    parser.add_argument('--latency', type=float, help='Delay of every mock response, in seconds')
+    parser.add_argument('--jitter', type=float, help='Random extra delay of mock responses, in seconds')
+    parser.add_argument('--error-rate', type=float, help='Share of mock responses failed with code 503')
+    parser.add_argument('--refresh-period', type=float, help='Account poll period')
+    parser.add_argument('--adaptive-polling', action='store_true', default=None, help='Use adaptive polling')
+    parser.add_argument('--drain-timeout', type=float, help='How long to wait for pending orders after the run')
+    parser.add_argument('--json', dest='json_path', help='Also write the report to this file')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Show account output')
+    args = parser.parse_args()
+
+    scenario = dict(DEFAULTS, **SCENARIOS[args.scenario])
+    for key in DEFAULTS:
+        if getattr(args, key, None) is not None:
+            scenario[key] = getattr(args, key)
+
+    report = run(args.scenario, scenario, args.verbose)
+    print_report(report)
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump(report, f, indent=4)
@@ -0,0 +1,244 @@
+import asyncio
+from time import perf_counter
+from types import SimpleNamespace
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Literal, Optional
+from urllib.parse import urlparse
+from requests.cookies import RequestsCookieJar, get_cookie_header, morsel_to_cookie
+
+from buff163.client import BaseBuff163Client
+from buff163.exceptions import BuffLoginError
+from buff163.models import Order, Trade, loads, parse_orders, parse_trades
+from metrics import timed
+
+try:
+    import aiohttp
+
+except ImportError:  # asyncio runtime is optional
+    aiohttp = None
+
+
+class AsyncResponse:
+    def __init__(self, status: int, url: str, body: bytes):
+        self.status_code = status
+        self.url = url
+        self.content = body
+
+    @property
+    def text(self) -> str:
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self):
+        return loads(self.content)
+
+
+class AsyncBuff163Client(BaseBuff163Client):
+    CONNECTOR_LIMIT = 100
+    KEEPALIVE_TIMEOUT = 60
+    MAX_RETRIES = 3
+    BACKOFF_FACTOR = 0.5
+    RETRY_STATUSES = (500, 502, 503, 504)
+    _connectors: Dict[Optional[str], 'aiohttp.BaseConnector'] = {}
+
+    def __init__(self, account_cfg, cookies: RequestsCookieJar, semaphore: Optional[asyncio.Semaphore] = None,
+                 rate_limiter=None, session_check_ttl: float = BaseBuff163Client.SESSION_CHECK_TTL,
+                 proxy_health=None):
+        if aiohttp is None:
+            raise ImportError('aiohttp is required for the asyncio runtime')
+
+        super().__init__(account_cfg, session_check_ttl)
+        self.cookies = cookies
+        # global limit of concurrent requests, shared by all clients of the runtime
+        self.semaphore = semaphore
+        self.rate_limiter = rate_limiter
+        self.proxy_health = proxy_health
+        self._session: Optional['aiohttp.ClientSession'] = None
+        # session of the previous proxy, closed before the next request
+        self._old_session: Optional['aiohttp.ClientSession'] = None
+        self._request_proxy: Optional[str] = None
+
+    @classmethod
+    def get_connector(cls, proxy: Optional[str]) -> 'aiohttp.BaseConnector':
+        # clients using the same proxy share one connection pool
+        key = proxy if proxy is not None and proxy.startswith('socks') else None
+        if key not in cls._connectors:
+            if key is not None:
+                from aiohttp_socks import ProxyConnector
+                cls._connectors[key] = ProxyConnector.from_url(key, limit=cls.CONNECTOR_LIMIT)
+
+            else:
+                cls._connectors[key] = aiohttp.TCPConnector(limit=cls.CONNECTOR_LIMIT, keepalive_timeout=cls.KEEPALIVE_TIMEOUT)
+
+        return cls._connectors[key]
+
+    @classmethod
+    async def close_connectors(cls):
+        for connector in cls._connectors.values():
+            await connector.close()
+
+        cls._connectors.clear()
+
+    def _create_session(self):
+        proxy = self.proxies.get('https', None)
+        if proxy is None or not proxy.startswith('socks'):
+            self._request_proxy = proxy
+
+        else:
+            # socks proxies are handled by the connector
+            self._request_proxy = None
+
+        # cookies are kept in the requests cookie jar shared with the steam client
+        self._session = aiohttp.ClientSession(connector=self.get_connector(proxy), connector_owner=False,
+                                              headers={'User-Agent': self.USER_AGENT},
+                                              cookie_jar=aiohttp.DummyCookieJar())
+
+    def switch_proxies(self, proxies: Dict[str, str]):
+        self.proxies = proxies
+        if self._session is not None:
+            # the connector depends on the proxy, the next request creates a new session
+            self._old_session = self._session
+            self._session = None
+
+    async def close(self):
+        if self._old_session is not None:
+            await self._old_session.close()
+            self._old_session = None
+
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _update_cookies(self, url: str, resp: 'aiohttp.ClientResponse'):
+        host = urlparse(url).hostname
+        for morsel in resp.cookies.values():
+            cookie = morsel_to_cookie(morsel)
+            if not cookie.domain:
+                cookie.domain = host
+
+            self.cookies.set_cookie(cookie)
+
+    def record_proxy(self, elapsed: float, ok: bool):
+        if self.proxy_health is not None:
+            self.proxy_health.record(self.proxies.get('https', None), elapsed, ok)
+
+    async def _request(self, method: str, url: str, **kwargs) -> AsyncResponse:
+        if self._old_session is not None:
+            await self._old_session.close()
+            self._old_session = None
+
+        if self._session is None:
+            self._create_session()
+
+        headers = kwargs.pop('headers', {})
+        cookie_header = get_cookie_header(self.cookies, SimpleNamespace(url=url, headers={}))
+        if cookie_header:
+            headers['Cookie'] = cookie_header
+
+        # only idempotent requests are retried, trade actions are never repeated
+        retries = self.MAX_RETRIES if method == 'GET' else 0
+        for attempt in range(retries + 1):
+            request_start = perf_counter()
+            try:
+                if self.rate_limiter is not None:
+                    await self.rate_limiter.acquire_async(urlparse(url).hostname, self.proxies.get('https', None))
+
+                async with self.semaphore:
+                    request_start = perf_counter()
+                    async with self._session.request(method, url, headers=headers, proxy=self._request_proxy,
+                                                     allow_redirects=False, **kwargs) as resp:
+                        self._update_cookies(url, resp)
+                        result = AsyncResponse(resp.status, str(resp.url), await resp.read())
+
+                    self.record_proxy(perf_counter() - request_start, True)
+
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                self.record_proxy(perf_counter() - request_start, False)
+                if attempt == retries:
+                    raise
+
+                await asyncio.sleep(self.BACKOFF_FACTOR * 2 ** attempt)
+                continue
+
+            if result.status_code not in self.RETRY_STATUSES or attempt == retries:
+                return result
+
+            await asyncio.sleep(self.BACKOFF_FACTOR * 2 ** attempt)
+
+    async def api_get_json_data(self, method: str, url: str, exception_msg: str, **kwargs):
+        resp = await self._request(method, url, **kwargs)
+        self.check_api_status(resp.status_code, exception_msg)
+        return self.get_api_data(resp.json(), exception_msg)
+
+    @timed('buff')
+    async def is_session_alive(self, use_cache: bool = True) -> bool:
+        alive = self.get_cached_session_check() if use_cache else None
+        if alive is not None:
+            return alive
+
+        resp = await self._request('GET', self.SESSION_CHECK_URL)
+        return self.parse_session_check(resp.status_code, resp.json)
+
+    @timed('buff')
+    async def login(self, force=False) -> bool:
+        if not force:
+            if await self.is_session_alive():
+                print(f'Buff session for {self.username} is alive')
+                return False
+
+            print(f'Buff session for {self.username} is not alive, logging in')
+
+        else:
+            print(f'logging in buff ({self.username})')
+
+        # openid login goes through the steam session, which is synchronous
+        await asyncio.get_running_loop().run_in_executor(None, self.openid_callback, self.OPENID_URL)
+        if await self.is_session_alive(use_cache=False):
+            print(f'Buff login for {self.username} OK')
+            return True
+
+        raise BuffLoginError('Failed to login buff')
+
+    @classmethod
+    async def iter_pages(cls, fetch_page: Callable[[int], Awaitable[List[Order]]],
+                         page_size: int) -> AsyncIterator[List[Order]]:
+        for page_num in range(1, cls.MAX_PAGES + 1):
+            orders = await fetch_page(page_num)
+            yield orders
+            if len(orders) < page_size:
+                return
+
+    @timed('buff')
+    async def get_items_to_deliver(self, game: str, page_num: int = 1, page_size: int = 10) -> List[Order]:
+        url = f'https://buff.163.com/api/market/sell_order/to_deliver?game={game}&page_num={page_num}&page_size={page_size}'
+        jresp = await self.api_get_json_data('GET', url, 'Failed to get items to deliver')
+        return parse_orders(jresp['items'])
+
+    def iter_items_to_deliver(self, game: str, page_size: int = 10) -> AsyncIterator[List[Order]]:
+        return self.iter_pages(lambda page_num: self.get_items_to_deliver(game, page_num, page_size), page_size)
+
+    @timed('buff')
+    async def get_items_to_send_offer(self, game: str, page_num: int = 1, page_size: int = 10) -> List[Order]:
+        url = f'https://buff.163.com/api/market/buy_order/history?game={game}&page_num={page_num}&page_size={page_size}'
+        jresp = await self.api_get_json_data('GET', url, 'Failed to get items to send offer')
+        return parse_orders(jresp['items'])
+
+    def iter_items_to_send_offer(self, game: str, page_size: int = 10) -> AsyncIterator[List[Order]]:
+        return self.iter_pages(lambda page_num: self.get_items_to_send_offer(game, page_num, page_size), page_size)
+
+    @timed('buff')
+    async def get_notifications(self):
+        url = 'https://buff.163.com/api/message/notification'
+        jresp = await self.api_get_json_data('GET', url, 'Failed to get notifications')
+        return self.check_notifications(jresp)
+
+    @timed('buff')
+    async def get_trades_to_accept(self) -> List[Trade]:
+        url = 'https://buff.163.com/api/market/steam_trade'
+        jresp = await self.api_get_json_data('GET', url, 'Failed to get trades to accept')
+        return parse_trades(jresp)
+
+    @timed('buff')
+    async def send_trade_offers(self, role: Literal['buyer', 'seller'], ids: List[str]):
+        data = self.get_send_offer_data(self.cookies, role, ids)
+        url = f'https://buff.163.com/api/market/manual_plus/{role}_send_offer'
+        return await self.api_get_json_data('POST', url, 'Failed to send trade', json=data,
+                                            headers=dict(self.SEND_OFFER_HEADERS))
@@ -1,20 +1,136 @@
 from requests import Response, Session
 from requests.cookies import RequestsCookieJar
-from typing import Callable, List, Literal, Union
-import os
+from time import monotonic
+from typing import TYPE_CHECKING, Callable, Dict, Iterator, List, Literal, Optional, Tuple, Union
 
-from buff163.cookie_encryptor import CookieEncryptor
 from buff163.exceptions import BuffError, BuffHTTPCodeError, BuffLoginError
+from buff163.models import Order, Trade, loads, parse_orders, parse_trades
+from metrics import timed
+from proxy_pool import parse_proxy
 
-class Buff163Client:
+if TYPE_CHECKING:
+    # cryptography is imported only when an account starts
+    from buff163.cookie_encryptor import CookieEncryptor
+
+class BaseBuff163Client:
     USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/121.0.0.0 Safari/537.36'
     OPENID_URL = 'https://buff.163.com/account/login/steam?back_url=/'
+    # small json response, much cheaper than a html page
+    SESSION_CHECK_URL = 'https://buff.163.com/account/api/user/info'
+    SESSION_CHECK_TTL = 60
+    # buff requires these headers, otherwise you will get a csrf error
+    SEND_OFFER_HEADERS = {
+        'System-Type': 'Android',
+        'System-Version': '33'
+    }
+    # order lists are paginated, a page is a few items larger than the notification count
+    PAGE_MARGIN = 5
+    MAX_PAGE_SIZE = 50
+    MAX_PAGES = 10
 
-    def __init__(self, account_cfg, cookies: Union[RequestsCookieJar, dict]):
+    def __init__(self, account_cfg, session_check_ttl: float = SESSION_CHECK_TTL):
         self._account_cfg = account_cfg
         self.username = self._account_cfg['username']
+        self.proxies = parse_proxy(account_cfg.get('proxy', None))
+
+        self.openid_callback: Callable = None
+        self._encryptor: Optional['CookieEncryptor'] = None
+        # (steam cookie values, encrypted cookies), regenerated only when a steam cookie changes
+        self._encrypted_cookies: Tuple[Tuple[str, ...], str] = ((), '')
+        self.session_check_ttl = session_check_ttl
+        # (check time, session is alive)
+        self._session_check: Optional[Tuple[float, bool]] = None
+
+    @classmethod
+    def get_page_size(cls, count: int) -> int:
+        return max(min(count + cls.PAGE_MARGIN, cls.MAX_PAGE_SIZE), 1)
+
+    @classmethod
+    def iter_pages(cls, fetch_page: Callable[[int], List[Order]], page_size: int) -> Iterator[List[Order]]:
+        # the next page is requested only if the caller asks for it
+        for page_num in range(1, cls.MAX_PAGES + 1):
+            orders = fetch_page(page_num)
+            yield orders
+            if len(orders) < page_size:
+                return
+
+    def get_cached_session_check(self) -> Optional[bool]:
+        if self._session_check is None or monotonic() - self._session_check[0] > self.session_check_ttl:
+            return None
+
+        return self._session_check[1]
+
+    def set_session_check(self, alive: bool):
+        self._session_check = (monotonic(), alive)
+
+    def parse_session_check(self, status_code: int, jresp_getter: Callable) -> bool:
+        if status_code // 100 == 3:
+            alive = False
+
+        elif status_code >= 400:
+            raise BuffHTTPCodeError(f'Failed to check if session is alive. Code {status_code}')
+
+        else:
+            jresp = jresp_getter()
+            alive = jresp['code'].lower() == 'ok' and bool(jresp.get('data', None))
+
+        self.set_session_check(alive)
+        return alive
+
+    def check_api_status(self, status_code: int, exception_msg: str):
+        if status_code // 100 == 3:  # redirect, this means user is not logger in
+            self.set_session_check(False)
+            raise BuffLoginError(f'{exception_msg}. User is not logged in')
+
+        if status_code >= 400:
+            raise BuffHTTPCodeError(f'{exception_msg}. Code {status_code}')
+
+    @staticmethod
+    def get_api_data(jresp, exception_msg: str):
+        if jresp['code'].lower() != 'ok':
+            raise BuffError(f'{exception_msg}. Message: {jresp["code"]}. {jresp["error"]}')
+
+        return jresp['data']
+
+    def check_notifications(self, jresp):
+        if len(jresp['updated_at']) == 0 and sum((int(count) for count in category.values()) for category in jresp.values()) == 0:
+            self.set_session_check(False)
+            raise BuffLoginError('Failed to get notifications. User is not logged in')
+
+        return jresp
+
+    def load_encryptor(self) -> 'CookieEncryptor':
+        # cryptography is imported only by accounts which run, not by one-shot modes
+        if self._encryptor is None:
+            from buff163.cookie_encryptor import CookieEncryptor
+            self._encryptor = CookieEncryptor.shared()
+
+        return self._encryptor
+
+    def get_encrypted_cookies(self, cookie_jar: RequestsCookieJar) -> str:
+        encryptor = self.load_encryptor()
+        cookie_values = encryptor.get_cookie_values(cookie_jar)
+        cached_values, encrypted = self._encrypted_cookies
+        if cookie_values != cached_values:
+            encrypted = encryptor.encrypt(encryptor.format_cookie_string(cookie_values))
+            self._encrypted_cookies = (cookie_values, encrypted)
+
+        return encrypted
+
+    def get_send_offer_data(self, cookie_jar: RequestsCookieJar, role: Literal['buyer', 'seller'], ids: List[str]):
+        return {
+            'bill_orders': ids,
+            f'{role}_info': self.get_encrypted_cookies(cookie_jar)
+        }
+
+
+class Buff163Client(BaseBuff163Client):
+    def __init__(self, account_cfg, cookies: Union[RequestsCookieJar, dict], http_pool=None,
+                 session_check_ttl: float = BaseBuff163Client.SESSION_CHECK_TTL):
+        super().__init__(account_cfg, session_check_ttl)
         self._session = Session()
         self._session.headers['User-Agent'] = self.USER_AGENT
+        self.http_pool = http_pool
 
         if isinstance(cookies, dict):
             self._session.cookies.update(cookies)
@@ -22,23 +138,28 @@ class Buff163Client:
         else:
             self._session.cookies = cookies
 
-        if account_cfg.get('proxy', None) is not None:
-            if isinstance(account_cfg['proxy'], str):
-                self._session.proxies.update({'http': account_cfg['proxy'], 'https': account_cfg['proxy']})
+        self.switch_proxies(self.proxies)
 
-            else:
-                self._session.proxies.update(account_cfg['proxy'])
+    def switch_proxies(self, proxies: Dict[str, str]):
+        self.proxies = proxies
+        if self.http_pool is not None:
+            # buff polls are plain GETs, they can be safely retried
+            self.http_pool.configure_session(self._session, self.proxies, retry_gets=True)
 
-        self.openid_callback: Callable = None
+        else:
+            # requests of other threads see either the old or the new proxies
+            self._session.proxies = dict(self.proxies)
 
-    def is_session_alive(self) -> bool:
-        resp = self._session.get('https://buff.163.com/news/')
-        if not resp.ok:
-            raise BuffHTTPCodeError(f'Failed to check if session is alive. Code {resp.status_code}')
-        
-        resp_txt = resp.text
-        return '"user": {"' in resp_txt and '"nickname": "' in resp_txt
+    @timed('buff')
+    def is_session_alive(self, use_cache: bool = True) -> bool:
+        alive = self.get_cached_session_check() if use_cache else None
+        if alive is not None:
+            return alive
+
+        resp = self._session.get(self.SESSION_CHECK_URL, allow_redirects=False)
+        return self.parse_session_check(resp.status_code, lambda: loads(resp.content))
     
+    @timed('buff')
     def login(self, force=False) -> bool:
         if not force:
             print(f'Checking buff session for {self.username}... ', end='')
@@ -53,66 +174,54 @@ class Buff163Client:
             print(f'logging in buff ({self.username})... ', end='')
         
         self.openid_callback(self.OPENID_URL)
-        if self.is_session_alive():
+        if self.is_session_alive(use_cache=False):
             print('OK')
             return True
         
         raise BuffLoginError('Failed to login buff')
     
-    @staticmethod
-    def api_get_json_data(resp: Response, exception_msg: str):
-        if resp.status_code // 100 == 3:  # redirect, this means user is not logger in
-            raise BuffLoginError(f'{exception_msg}. User is not logged in')
-
-        if not resp.ok:
-            raise BuffHTTPCodeError(f'{exception_msg}. Code {resp.status_code}')
-        
-        jresp = resp.json()
-        if jresp['code'].lower() != 'ok':
-            raise BuffError(f'{exception_msg}. Message: {jresp["code"]}. {jresp["error"]}')
-        
-        return jresp['data']
+    def api_get_json_data(self, resp: Response, exception_msg: str):
+        self.check_api_status(resp.status_code, exception_msg)
+        return self.get_api_data(loads(resp.content), exception_msg)
 
-    def get_items_to_deliver(self, game: str):
-        url = f'https://buff.163.com/api/market/sell_order/to_deliver?game={game}'
+    @timed('buff')
+    def get_items_to_deliver(self, game: str, page_num: int = 1, page_size: int = 10) -> List[Order]:
+        url = f'https://buff.163.com/api/market/sell_order/to_deliver?game={game}&page_num={page_num}&page_size={page_size}'
         resp = self._session.get(url, allow_redirects=False)
         jresp = self.api_get_json_data(resp, 'Failed to get items to deliver')
-        return jresp
+        return parse_orders(jresp['items'])
+
+    def iter_items_to_deliver(self, game: str, page_size: int = 10) -> Iterator[List[Order]]:
+        return self.iter_pages(lambda page_num: self.get_items_to_deliver(game, page_num, page_size), page_size)
     
-    def get_items_to_send_offer(self, game: str, count: int = 10):
-        url = f'https://buff.163.com/api/market/buy_order/history?game={game}&page_num=1&page_size={count}'
+    @timed('buff')
+    def get_items_to_send_offer(self, game: str, page_num: int = 1, page_size: int = 10) -> List[Order]:
+        url = f'https://buff.163.com/api/market/buy_order/history?game={game}&page_num={page_num}&page_size={page_size}'
         resp = self._session.get(url, allow_redirects=False)
         jresp = self.api_get_json_data(resp, 'Failed to get items to send offer')
-        return jresp
+        return parse_orders(jresp['items'])
+
+    def iter_items_to_send_offer(self, game: str, page_size: int = 10) -> Iterator[List[Order]]:
+        return self.iter_pages(lambda page_num: self.get_items_to_send_offer(game, page_num, page_size), page_size)
     
+    @timed('buff')
     def get_notifications(self):
         url = f'https://buff.163.com/api/message/notification'
         resp = self._session.get(url, allow_redirects=False)
         jresp = self.api_get_json_data(resp, 'Failed to get notifications')
-
-        if len(jresp['updated_at']) == 0 and sum((int(count) for count in category.values()) for category in jresp.values()) == 0:
-            raise BuffLoginError('Failed to get notifications. User is not logged in')
-        
-        return jresp
+        return self.check_notifications(jresp)
     
-    def get_trades_to_accept(self):
+    @timed('buff')
+    def get_trades_to_accept(self) -> List[Trade]:
         url = 'https://buff.163.com/api/market/steam_trade'
         resp = self._session.get(url, allow_redirects=False)
         jresp = self.api_get_json_data(resp, 'Failed to get trades to accept')
-        return jresp
+        return parse_trades(jresp)
     
+    @timed('buff')
     def send_trade_offers(self, role: Literal['buyer', 'seller'], ids: List[str]):
-        encryptor = CookieEncryptor(os.path.join(os.path.dirname(__file__), 'buff_pubkey.pem'))
-        data = {
-            'bill_orders': ids,
-            f'{role}_info': encryptor.encrypt(encryptor.get_cookie_string(self._session.cookies))
-        }
-        # buff requires these headers, otherwise you will get a csrf error
-        headers = {
-            'System-Type': 'Android',
-            'System-Version': '33'
-        }
+        data = self.get_send_offer_data(self._session.cookies, role, ids)
         url = f'https://buff.163.com/api/market/manual_plus/{role}_send_offer'
-        resp = self._session.post(url, json=data, headers=headers, allow_redirects=False)
+        resp = self._session.post(url, json=data, headers=self.SEND_OFFER_HEADERS, allow_redirects=False)
         jresp = self.api_get_json_data(resp, 'Failed to send trade')
         return jresp
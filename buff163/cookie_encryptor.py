@@ -4,8 +4,13 @@ from cryptography.hazmat.primitives.serialization import load_pem_public_key
 from cryptography.hazmat.primitives.asymmetric import padding
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from pkcs7 import PKCS7Encoder
+from threading import Lock
+from typing import Tuple
 import os
 
+PUBKEY_FILE = os.path.join(os.path.dirname(__file__), 'buff_pubkey.pem')
+
+
 class CookieEncryptor:
     COOKIE_STR = [
         {'name': 'steamLoginSecure', 'domain': 'store.steampowered.com'},
@@ -14,6 +19,8 @@ class CookieEncryptor:
         {'name': 'steamCountry', 'domain': 'steamcommunity.com'},
         {'name': 'steamLoginSecure', 'domain': 'steamcommunity.com'}
     ]
+    _shared = None
+    _shared_lock = Lock()
 
     def __init__(self, pubkey_file):
         with open(pubkey_file, 'rb') as f:
@@ -22,9 +29,27 @@ class CookieEncryptor:
         self.pkcs7_encoder = PKCS7Encoder(16)
         self.padding = padding.PKCS1v15()
 
+    @classmethod
+    def shared(cls) -> 'CookieEncryptor':
+        # the public key is parsed once per process, the encryptor has no per-call state
+        if cls._shared is None:
+            with cls._shared_lock:
+                if cls._shared is None:
+                    cls._shared = cls(PUBKEY_FILE)
+
+        return cls._shared
+
+    @classmethod
+    def get_cookie_values(cls, cookie_jar: RequestsCookieJar) -> Tuple[str, ...]:
+        return tuple(cookie_jar.get(**cookie) for cookie in cls.COOKIE_STR)
+
+    @classmethod
+    def format_cookie_string(cls, cookie_values: Tuple[str, ...]):
+        return '; '.join(cookie['name'] + '=' + value for cookie, value in zip(cls.COOKIE_STR, cookie_values))
+
     @classmethod
     def get_cookie_string(cls, cookie_jar: RequestsCookieJar):
-        return '; '.join(cookie['name'] + '=' + cookie_jar.get(**cookie) for cookie in cls.COOKIE_STR)
+        return cls.format_cookie_string(cls.get_cookie_values(cookie_jar))
 
     def encrypt(self, cookie_str: str):
         key = os.urandom(16)
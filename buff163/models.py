@@ -0,0 +1,61 @@
+import json
+import sys
+from typing import Iterable, List, Optional
+
+try:
+    import orjson
+
+except ImportError:  # optional, faster decoding of buff responses
+    orjson = None
+
+
+def loads(content: bytes):
+    if orjson is not None:
+        return orjson.loads(content)
+
+    return json.loads(content)
+
+
+def intern_id(value) -> Optional[str]:
+    # ids are kept in dedup sets for days, one string object per id is enough
+    return sys.intern(str(value)) if value is not None else None
+
+
+class Order:
+    # Fields of a buff order used by the trade logic, item descriptions are dropped right after decoding
+    __slots__ = ('id', 'state', 'type', 'tradeofferid', 'is_seller_asked_to_send_offer', 'has_sent_offer')
+
+    def __init__(self, id: str, state: Optional[str], type: Optional[int], tradeofferid: Optional[str],
+                 is_seller_asked_to_send_offer: bool, has_sent_offer: bool):
+        self.id = id
+        self.state = state
+        self.type = type
+        self.tradeofferid = tradeofferid
+        self.is_seller_asked_to_send_offer = is_seller_asked_to_send_offer
+        self.has_sent_offer = has_sent_offer
+
+    @classmethod
+    def from_json(cls, item: dict) -> 'Order':
+        return cls(intern_id(item['id']), item.get('state', None), item.get('type', None),
+                   intern_id(item.get('tradeofferid', None)), bool(item.get('is_seller_asked_to_send_offer', False)),
+                   bool(item.get('has_sent_offer', False)))
+
+
+class Trade:
+    # A steam trade offer which buff asks to accept
+    __slots__ = ('tradeofferid',)
+
+    def __init__(self, tradeofferid: str):
+        self.tradeofferid = tradeofferid
+
+    @classmethod
+    def from_json(cls, item: dict) -> 'Trade':
+        return cls(intern_id(item['tradeofferid']))
+
+
+def parse_orders(items: Iterable[dict]) -> List[Order]:
+    return [Order.from_json(item) for item in items]
+
+
+def parse_trades(items: Iterable[dict]) -> List[Trade]:
+    return [Trade.from_json(item) for item in items]
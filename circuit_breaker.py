@@ -0,0 +1,189 @@
+import asyncio
+import json
+import random
+import sys
+from time import monotonic
+from typing import Collection, Dict, Optional
+from urllib.parse import urlparse
+from requests import HTTPError
+from steampy.exceptions import ApiException, ConfirmationExpected, InvalidCredentials, LoginRequired
+
+from buff163.exceptions import BuffError, BuffHTTPCodeError, BuffLoginError
+from exceptions import SteamConfirmationError, SteamHTTPCodeError, SteamSessionError
+from metrics import CIRCUIT_OPEN
+
+BUFF = 'buff'
+STEAM = 'steam'
+# hosts of errors which do not keep their request
+DEFAULT_HOSTS = {BUFF: 'buff.163.com', STEAM: 'steamcommunity.com'}
+
+SESSION = 'session'  # logged out, the failed side has to log in again
+NETWORK = 'network'  # connection errors and timeouts
+HTTP = 'http'  # unexpected status codes
+API = 'api'  # error responses
+UNKNOWN = 'unknown'
+
+
+class ErrorInfo:
+    __slots__ = ('kind', 'host', 'side')
+
+    def __init__(self, kind: str, host: Optional[str], side: Optional[str]):
+        self.kind = kind
+        self.host = host
+        self.side = side
+
+    @property
+    def key(self) -> str:
+        return self.host or self.side or UNKNOWN
+
+
+def get_error_host(exception: Exception) -> Optional[str]:
+    # requests exceptions keep the request, aiohttp connection errors keep the host
+    request = getattr(exception, 'request', None)
+    url = getattr(request, 'url', None)
+    if isinstance(url, str):
+        return urlparse(url).hostname
+
+    request_info = getattr(exception, 'request_info', None)
+    if request_info is not None:
+        return request_info.url.host
+
+    host = getattr(exception, 'host', None)
+    return host if isinstance(host, str) else None
+
+
+def get_host_side(host: Optional[str]) -> Optional[str]:
+    if host is None:
+        return None
+
+    if host.endswith('163.com'):
+        return BUFF
+
+    if 'steam' in host:
+        return STEAM
+
+    return None
+
+
+def classify_error(exception: Exception) -> ErrorInfo:
+    host = get_error_host(exception)
+    if isinstance(exception, BuffLoginError):
+        return ErrorInfo(SESSION, host or DEFAULT_HOSTS[BUFF], BUFF)
+
+    if isinstance(exception, (LoginRequired, InvalidCredentials, SteamSessionError)):
+        return ErrorInfo(SESSION, host or DEFAULT_HOSTS[STEAM], STEAM)
+
+    if isinstance(exception, (BuffHTTPCodeError, SteamHTTPCodeError, HTTPError)):
+        kind = HTTP
+
+    elif isinstance(exception, (OSError, asyncio.TimeoutError)):
+        # requests exceptions are OSErrors too
+        kind = NETWORK
+
+    elif 'aiohttp' in sys.modules and isinstance(exception, sys.modules['aiohttp'].ClientError):
+        # aiohttp is not imported here, its exceptions exist only if the asyncio runtime loaded it
+        kind = NETWORK
+
+    elif isinstance(exception, (BuffError, ApiException, ConfirmationExpected, SteamConfirmationError,
+                                json.JSONDecodeError)):
+        kind = API
+
+    else:
+        kind = UNKNOWN
+
+    side = get_host_side(host)
+    if side is None:
+        if isinstance(exception, (BuffError, BuffHTTPCodeError)):
+            side = BUFF
+
+        elif isinstance(exception, (SteamHTTPCodeError, SteamConfirmationError, ApiException, ConfirmationExpected)):
+            side = STEAM
+
+    return ErrorInfo(kind, host or DEFAULT_HOSTS.get(side, None), side)
+
+
+class CircuitBreaker:
+    # Open after a failure, for an exponentially growing time with jitter.
+    # When the time is over the breaker is half-open: the next tick is a probe, which closes it on success
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, username: str, key: str, base_delay: float, max_delay: float, jitter: float):
+        self.username = username
+        self.key = key
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.state = self.CLOSED
+        self.failures = 0
+        self.open_until = 0.0
+
+    def record_failure(self) -> float:
+        self.failures += 1
+        delay = min(self.base_delay * 2 ** (self.failures - 1), self.max_delay)
+        delay *= random.uniform(1 - self.jitter, 1 + self.jitter)
+        self.state = self.OPEN
+        self.open_until = monotonic() + delay
+        CIRCUIT_OPEN.set(1, account=self.username, host=self.key)
+        return delay
+
+    def record_success(self):
+        if self.state == self.CLOSED:
+            return
+
+        print(f'[{self.username}] {self.key} recovered after {self.failures} failures')
+        self.state = self.CLOSED
+        self.failures = 0
+        CIRCUIT_OPEN.set(0, account=self.username, host=self.key)
+
+    def get_remaining(self) -> float:
+        if self.state != self.OPEN:
+            return 0
+
+        remaining = self.open_until - monotonic()
+        if remaining <= 0:
+            self.state = self.HALF_OPEN
+            return 0
+
+        return remaining
+
+
+class CircuitBreakers:
+    # One breaker for every failing host of an account
+    BASE_DELAY = 5
+    MAX_DELAY = 1800
+    JITTER = 0.2
+    # consecutive failures after which a notification is sent, once per outage
+    NOTIFY_AFTER = 3
+
+    def __init__(self, username: str, base_delay: float = BASE_DELAY, max_delay: float = MAX_DELAY,
+                 jitter: float = JITTER):
+        self.username = username
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.breakers: Dict[str, CircuitBreaker] = {}
+
+    def get(self, error: ErrorInfo) -> CircuitBreaker:
+        if error.key not in self.breakers:
+            self.breakers[error.key] = CircuitBreaker(self.username, error.key, self.base_delay, self.max_delay,
+                                                      self.jitter)
+
+        return self.breakers[error.key]
+
+    def record_failure(self, error: ErrorInfo) -> float:
+        return self.get(error).record_failure()
+
+    def get_delay(self, error: ErrorInfo) -> float:
+        # time left until the breaker of the error is half-open
+        return self.get(error).get_remaining()
+
+    def should_notify(self, error: ErrorInfo) -> bool:
+        return self.get(error).failures == self.NOTIFY_AFTER
+
+    def record_success(self, exclude: Collection[str] = ()):
+        # a successful tick is the probe of every half-open breaker, except the excluded keys
+        for key, breaker in self.breakers.items():
+            if key not in exclude and breaker.get_remaining() == 0:
+                breaker.record_success()
@@ -1,40 +1,178 @@
 import os
-from typing import Dict
+import tempfile
+from typing import Dict, List, Optional
 from requests.cookies import RequestsCookieJar
 import json
 
 
+class TrackedCookieJar(RequestsCookieJar):
+    # Remembers whether it was modified since the last save, so unchanged jars are not serialised again
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.changed = True
+
+    def set_cookie(self, cookie, *args, **kwargs):
+        self.changed = True
+        return super().set_cookie(cookie, *args, **kwargs)
+
+    def clear(self, domain=None, path=None, name=None):
+        self.changed = True
+        return super().clear(domain, path, name)
+
+
 class CookieManager:
-    def __init__(self, filename: str, cookie_jars: Dict[str, RequestsCookieJar], save_enabled: bool = True):
+    def __init__(self, filename: str, cookie_jars: Dict[str, RequestsCookieJar], save_enabled: bool = True,
+                 sharded: bool = False, legacy_filename: Optional[str] = None):
         self.filename = filename
         self.cookie_jars = cookie_jars
         self.save_enabled = save_enabled
-        self.cookies = {}
+        # with sharded store, filename is a directory with one file per account
+        self.sharded = sharded
+        # single cookies file, accounts without their own file are migrated from it
+        self.legacy_filename = legacy_filename
+        # username -> serialised cookies, accounts which are not loaded are kept as they were read
+        self.cookies: Dict[str, str] = {}
+
+    def get_shard_filename(self, username: str) -> str:
+        return os.path.join(self.filename, f'{username}.json')
+
+    @staticmethod
+    def write_atomic(filename: str, data: str):
+        directory = os.path.dirname(os.path.abspath(filename))
+        fd, tmp_filename = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(filename), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+
+            os.replace(tmp_filename, filename)
+
+        except:
+            os.remove(tmp_filename)
+            raise
+
+    def read_cookies_file(self, filename: Optional[str] = None) -> Dict[str, str]:
+        filename = filename or self.filename
+        with open(filename, 'r') as f:
+            lines = f.read().split('\n')
+
+        # every account is saved on its own line, so only accounts in use have to be parsed
+        if len(lines) > 1 and lines[0] == '{' and lines[-1] == '}':
+            decoder = json.JSONDecoder()
+            cookies = {}
+            for line in filter(None, lines[1:-1]):
+                username, end = decoder.raw_decode(line)
+                cookies[username] = line[end:].lstrip(': ').rstrip(',')
+
+            return cookies
+
+        with open(filename, 'r') as f:
+            return {username: json.dumps(user_cookies) for username, user_cookies in json.load(f).items()}
+
+    def load_jar(self, username: str, user_cookies: List[dict]):
+        for cookie in user_cookies:
+            self.cookie_jars[username].set(**cookie)
+
+        if isinstance(self.cookie_jars[username], TrackedCookieJar):
+            self.cookie_jars[username].changed = False
+
+    def load_account(self, username: str) -> bool:
+        # returns False if the account has no saved cookies
+        if self.sharded:
+            shard_filename = self.get_shard_filename(username)
+            if not os.path.exists(shard_filename):
+                return False
+
+            with open(shard_filename, 'r') as f:
+                self.cookies[username] = f.read()
+
+        elif username not in self.cookies:
+            return False
+
+        self.load_jar(username, json.loads(self.cookies[username]))
+        return True
+
+    def add(self, username: str, cookie_jar: RequestsCookieJar):
+        # accounts added while running are loaded from the cookies read at start-up or their own file
+        self.cookie_jars[username] = cookie_jar
+        if not self.load_account(username) and self.sharded and self.legacy_filename is not None \
+                and os.path.isfile(self.legacy_filename):
+            legacy_cookies = self.read_cookies_file(self.legacy_filename)
+            if username in legacy_cookies:
+                self.load_jar(username, json.loads(legacy_cookies[username]))
+
+    def remove(self, username: str):
+        # the last cookies of a removed account are kept in the file
+        self.save()
+        self.cookie_jars.pop(username, None)
 
     def load(self):
+        if self.sharded:
+            missing = []
+            for username in self.cookie_jars:
+                if not self.load_account(username):
+                    missing.append(username)
+
+            if missing and self.legacy_filename is not None and os.path.isfile(self.legacy_filename):
+                legacy_cookies = self.read_cookies_file(self.legacy_filename)
+                for username in missing:
+                    if username in legacy_cookies:
+                        # not stored in self.cookies, so the account is saved to its own file on the next save
+                        self.load_jar(username, json.loads(legacy_cookies[username]))
+
+            return
+
         if not os.path.exists(self.filename):
             return
-        
-        with open(self.filename, 'r') as f:
-            self.cookies = json.load(f)
 
+        self.cookies = self.read_cookies_file()
         for username, user_cookies in self.cookies.items():
             if username in self.cookie_jars:
-                for cookie in user_cookies:
-                    self.cookie_jars[username].set(**cookie)
+                self.load_jar(username, json.loads(user_cookies))
+
+    @staticmethod
+    def serialize_jar(cookie_jar: RequestsCookieJar) -> str:
+        return json.dumps([{
+            "name": c.name,
+            "value": c.value,
+            "domain": c.domain,
+            "path": c.path,
+            "expires": c.expires
+        } for c in cookie_jar])
+
+    def get_changed_accounts(self) -> List[str]:
+        changed = []
+        for username, cookie_jar in list(self.cookie_jars.items()):
+            tracked = isinstance(cookie_jar, TrackedCookieJar)
+            if tracked and not cookie_jar.changed and username in self.cookies:
+                continue
+
+            if tracked:
+                # reset before serialising, changes made meanwhile are saved next time
+                cookie_jar.changed = False
+
+            user_cookies = self.serialize_jar(cookie_jar)
+            if self.cookies.get(username, None) != user_cookies:
+                self.cookies[username] = user_cookies
+                changed.append(username)
+
+        return changed
 
     def save(self):
         if not self.save_enabled:
             return
-        
-        for username, user_cookies in self.cookie_jars.items():
-            self.cookies[username] = [{
-                "name": c.name,
-                "value": c.value,
-                "domain": c.domain,
-                "path": c.path,
-                "expires": c.expires
-            } for c in user_cookies]
-
-        with open(self.filename, 'w') as f:
-            json.dump(self.cookies, f)
+
+        changed = self.get_changed_accounts()
+        if len(changed) == 0:
+            return
+
+        if self.sharded:
+            os.makedirs(self.filename, exist_ok=True)
+            for username in changed:
+                self.write_atomic(self.get_shard_filename(username), self.cookies[username])
+
+            return
+
+        lines = [f'{json.dumps(username)}: {user_cookies}' for username, user_cookies in self.cookies.items()]
+        self.write_atomic(self.filename, '{\n' + ',\n'.join(lines) + '\n}')
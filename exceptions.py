@@ -1,2 +1,10 @@
 class SteamHTTPCodeError(Exception):
     pass
+
+
+class SteamConfirmationError(Exception):
+    pass
+
+
+class SteamSessionError(Exception):
+    pass
@@ -0,0 +1,99 @@
+from collections import OrderedDict
+from threading import Lock
+from time import perf_counter
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlparse
+from requests import ConnectionError, PreparedRequest, Response, Session, Timeout
+from requests.adapters import HTTPAdapter
+from requests.utils import select_proxy
+from urllib3.util.retry import Retry
+
+from proxy_pool import ProxyHealth
+from rate_limiter import RateLimiter
+
+
+class PooledHTTPAdapter(HTTPAdapter):
+    def __init__(self, rate_limiter: Optional[RateLimiter] = None, proxy_health: Optional[ProxyHealth] = None,
+                 **kwargs):
+        self.rate_limiter = rate_limiter
+        self.proxy_health = proxy_health
+        super().__init__(**kwargs)
+
+    def send(self, request: PreparedRequest, stream=False, timeout=None, verify=True, cert=None, proxies=None) -> Response:
+        proxy = select_proxy(request.url, proxies)
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(urlparse(request.url).hostname, proxy)
+
+        start = perf_counter()
+        try:
+            resp = super().send(request, stream=stream, timeout=timeout, verify=verify, cert=cert, proxies=proxies)
+
+        except (ConnectionError, Timeout):
+            # only connection failures count against the proxy, error responses come from the server
+            if self.proxy_health is not None:
+                self.proxy_health.record(proxy, perf_counter() - start, False)
+
+            raise
+
+        if self.proxy_health is not None:
+            self.proxy_health.record(proxy, perf_counter() - start, True)
+
+        return resp
+
+
+class HTTPPool:
+    # Sessions of all accounts using the same proxy share one adapter,
+    # so polls reuse warm keep-alive connections instead of opening new ones
+    POOL_CONNECTIONS = 10
+    POOL_MAXSIZE = 10
+    MAX_RETRIES = 3
+    BACKOFF_FACTOR = 0.5
+    RETRY_STATUSES = (500, 502, 503, 504)
+
+    def __init__(self, pool_connections: int = POOL_CONNECTIONS, pool_maxsize: int = POOL_MAXSIZE,
+                 max_retries: int = MAX_RETRIES, backoff_factor: float = BACKOFF_FACTOR,
+                 rate_limiter: Optional[RateLimiter] = None, proxy_health: Optional[ProxyHealth] = None):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.rate_limiter = rate_limiter
+        self.proxy_health = proxy_health
+        self._adapters: Dict[Tuple[Optional[str], bool], PooledHTTPAdapter] = {}
+        self._lock = Lock()
+
+    @staticmethod
+    def get_proxy_key(proxies: Dict[str, str]) -> Optional[str]:
+        return proxies.get('https', None) or proxies.get('http', None)
+
+    def create_adapter(self, retry_gets: bool) -> PooledHTTPAdapter:
+        max_retries = 0
+        if retry_gets:
+            # only idempotent requests are retried, trade actions are never repeated
+            max_retries = Retry(total=self.max_retries, backoff_factor=self.backoff_factor,
+                                status_forcelist=self.RETRY_STATUSES, allowed_methods=frozenset(('GET', 'HEAD')),
+                                raise_on_status=False)
+
+        return PooledHTTPAdapter(rate_limiter=self.rate_limiter, proxy_health=self.proxy_health,
+                                 pool_connections=self.pool_connections, pool_maxsize=self.pool_maxsize,
+                                 max_retries=max_retries)
+
+    def get_adapter(self, proxies: Dict[str, str], retry_gets: bool) -> PooledHTTPAdapter:
+        key = (self.get_proxy_key(proxies), retry_gets)
+        with self._lock:
+            if key not in self._adapters:
+                self._adapters[key] = self.create_adapter(retry_gets)
+
+            return self._adapters[key]
+
+    def configure_session(self, session: Session, proxies: Dict[str, str], retry_gets: bool = False):
+        # other threads send requests through the session meanwhile, so the proxies and adapters
+        # are replaced in one assignment instead of being changed in place
+        session.proxies = dict(proxies)
+        session.headers['Connection'] = 'keep-alive'
+        adapter = self.get_adapter(proxies, retry_gets)
+        if session.adapters.get('https://') is not adapter or session.adapters.get('http://') is not adapter:
+            adapters = OrderedDict(session.adapters)
+            adapters['https://'] = adapter
+            adapters['http://'] = adapter
+            session.adapters = adapters
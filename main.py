@@ -1,246 +1,548 @@
+from time import monotonic, perf_counter
+# imports are timed from here by the start-up report
+IMPORT_START = perf_counter()
+
 import atexit
-from threading import Thread
-from time import time, sleep
-import traceback
-from requests.cookies import RequestsCookieJar
+import copy
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from threading import Event
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
 import json
-from argparse import ArgumentParser
-
-from cookie_manager import CookieManager
-from steam import AdvancedSteamClient
-from buff163.client import Buff163Client
-
-
-class Account(Thread):
-    EXCEPTION_TIMEOUT = 120
-    RETRY_FAIL_DELAY = 1800
-
-    def __init__(self, account_cfg, cookies: RequestsCookieJar, steam: AdvancedSteamClient,
-                 buff: Buff163Client, refresh_period: int, notifiers=None):
-        self._account_cfg = account_cfg
-        self.username = self._account_cfg['username']
-        self.cookies = cookies
-        self.steam = steam
-        self.buff = buff
-        self.refresh_period = refresh_period
-        self.notifiers = notifiers
-        super().__init__(name=self.username, daemon=True)
-        self.last_exception = 0
-        self.known_ids = set()
-        self.accepted_trade_ids = set()
-        self.confirmed_trade_ids = set()
-
-    def login(self, force=False):
-        self.steam.login(force=force)
-        self.buff.login(force=force)
-
-    def accept_trade(self, tradeofferid: str):
-        if tradeofferid in self.accepted_trade_ids:
-            return
+import os
+import signal
+from argparse import ArgumentParser, Namespace
+
+from circuit_breaker import BUFF, STEAM
+from cookie_manager import CookieManager, TrackedCookieJar
+from http_pool import HTTPPool
+from metrics import METRICS, MetricsServer, StartupReport
+from notifiers import BaseNotifier, QueueNotifier
+from proxy_pool import ProxyHealth, ProxySelector, parse_proxy
+from rate_limiter import RateLimiter, strip_proxy_credentials
+from scheduler import AdaptivePollScheduler, FixedPollScheduler
+from session_refresher import SessionRefresher
+from trade_store import TradeIdStore
+from supervisor import get_shard
+
+if TYPE_CHECKING:
+    # steampy is imported only when accounts are created
+    from account import Account
+
+STARTUP = StartupReport(IMPORT_START)
+STARTUP.mark('imports')
+
+
+def create_arg_parser() -> ArgumentParser:
+    parser = ArgumentParser(prog='Buff163-autotrade',
+                            description='Tool to automate sending and receiving trades on buff163')
+    
+    parser.add_argument('-c', '--config', default='config.json', help='Path to config file')
+    parser.add_argument('-d', '--cookies', action='store', dest='cookies', default='cookies.json', help='Path to cookies file')
+    parser.add_argument('--cookies-dir', action='store', dest='cookies_dir', default=None, help='Save cookies of every account to its own file in this directory instead of the cookies file')
+    parser.add_argument('-n', '--no-cookies', action='store_false', dest='cookies_enabled', help='Do not save cookies file')
+    parser.add_argument('-t', '--trade-ids', action='store', dest='trade_ids', default='trade_ids.sqlite3', help='Path to handled trade ids database')
+    parser.add_argument('--no-trade-ids', action='store_false', dest='trade_ids_enabled', help='Do not save handled trade ids')
+    parser.add_argument('--trade-ids-ttl', action='store', dest='trade_ids_ttl', default=168, help='How long handled trade ids are kept, in hours', type=float)
+    parser.add_argument('-l', '--no-login-check', action='store_false', dest='login_check', help='Do not check if accounts are logged in')
+    parser.add_argument('-f', '--force-login', action='store_true', dest='force_login', help='Force login all accounts')
+    parser.add_argument('--session-check-ttl', action='store', dest='session_check_ttl', default=60, help='How long a buff session check result is reused, in seconds', type=float)
+    parser.add_argument('--no-session-refresh', action='store_false', dest='session_refresh', help='Do not log in again before sessions expire')
+    parser.add_argument('--session-refresh-before', action='store', dest='session_refresh_before', default=3600, help='How long before expiry sessions are refreshed, in seconds', type=float)
+    parser.add_argument('--startup-workers', action='store', dest='startup_workers', default=16, help='Number of accounts checked concurrently on start-up', type=int)
+    parser.add_argument('-p', '--parallel-login', action='store_true', dest='parallel_login', help='Log in accounts concurrently and start each one as soon as it is logged in')
+    parser.add_argument('-s', '--check-sessions', action='store_true', dest='check_sessions', help='Check if accounts are logged in and exit, with code 1 if any session is not alive')
+    parser.add_argument('-r', '--refresh-period', action='store', dest='refresh_period', default=30, help='Buff trades refresh period', type=int)
+    parser.add_argument('--adaptive-polling', action='store_true', dest='adaptive_polling', help='Poll fast while trades are pending and back off while idle')
+    parser.add_argument('--min-refresh-period', action='store', dest='min_refresh_period', default=5, help='Shortest refresh period in adaptive polling mode', type=float)
+    parser.add_argument('--max-refresh-period', action='store', dest='max_refresh_period', default=300, help='Longest refresh period in adaptive polling mode', type=float)
+    parser.add_argument('-m', '--metrics-port', action='store', dest='metrics_port', default=None, help='Serve prometheus metrics on this local port', type=int)
+    parser.add_argument('--no-config-reload', action='store_false', dest='config_reload', help='Do not apply changes of the config file while running')
+    parser.add_argument('--notify-test', action='store_true', dest='notify_test', help='Test notifications and exit')
+    parser.add_argument('--startup-report', action='store_true', dest='startup_report', help='Print time and memory taken by start-up')
+    parser.add_argument('-a', '--asyncio', action='store_true', dest='use_asyncio', help='Run all accounts on a single asyncio event loop')
+    parser.add_argument('--max-concurrent-requests', action='store', dest='max_concurrent_requests', default=64, help='Global limit of concurrent requests in asyncio mode', type=int)
+    parser.add_argument('--supervisor', action='store_true', dest='supervisor', help='Split accounts across worker processes')
+    parser.add_argument('-w', '--workers', action='store', dest='workers', default=os.cpu_count() or 1, help='Number of worker processes in supervisor mode', type=int)
+    return parser
+
+
+def read_config(path: str) -> dict:
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def create_notifiers(config: dict, start: bool = True) -> List[BaseNotifier]:
+    notifiers = []
+    if not config.get('notifiers', None):
+        return notifiers
+
+    if 'telegram_bot' in config['notifiers']:
+        from notifiers.telegram_bot_notifier import TelegramBotNotifier
+        notifier = TelegramBotNotifier(config['notifiers']['telegram_bot'])
+        notifiers.append(notifier)
+        if start:
+            notifier.start()
 
-        print(f'[{self.username}] Accepting trade offer')
-        self.steam.accept_trade_offer(tradeofferid)
-        self.accepted_trade_ids.add(tradeofferid)
-        print(f'[{self.username}] Success')
+    return notifiers
 
-    def confirm_trade(self, tradeofferid: str):
-        if tradeofferid in self.confirmed_trade_ids:
-            return
-        
-        self.steam._confirm_transaction(tradeofferid)
-        self.confirmed_trade_ids.add(tradeofferid)
-        print(f'[{self.username}] Confirmed trade {tradeofferid}')
-
-    def check_to_deliver(self, notifications):
-        ids_to_send_trade = []
-        for game, count in notifications['to_deliver_order'].items():
-            if count == 0:
-                continue
 
-            data = self.buff.get_items_to_deliver(game)
-            for item in data['items']:
-                need_send_offer = item['is_seller_asked_to_send_offer'] or item['type'] == 2
-                if need_send_offer and item['state'] == 'DELIVERING':
-                    self.confirm_trade(item['tradeofferid'])
+def test_notifiers(config: dict, timeout: float = 30) -> bool:
+    # the notifiers are not started, test messages are sent without polling for bot commands.
+    # Returns True only if every test message reached every recipient in time
+    notifiers = create_notifiers(config, start=False)
+    if len(notifiers) == 0:
+        print('No notifiers configured')
+        return False
 
-                if item['id'] in self.known_ids:
-                    continue
+    for notifier in notifiers:
+        notifier.notify_test()
 
-                if need_send_offer:
-                    if not item['has_sent_offer']:
-                        ids_to_send_trade.append(item['id'])
+    sent = all([notifier.flush(timeout) for notifier in notifiers])
+    return sent and all(notifier.failed_sends == 0 for notifier in notifiers)
 
-                else:
-                    self.accept_trade(item['tradeofferid'])
 
-        if len(ids_to_send_trade) > 0:
-            print(f'[{self.username}] Sending trade offer to buyer')
-            self.buff.send_trade_offers('seller', ids_to_send_trade)
-            print(f'[{self.username}] Success')
+class Buff163Autotrade:
+    MAINTENANCE_PERIOD = 300
+    CONFIG_CHECK_PERIOD = 5
+    # account settings which are changed without restarting the account
+    LIVE_SETTINGS = ('proxy', 'proxy_pool', 'process_sell_offers', 'process_buy_offers')
+
+    def __init__(self, args: Optional[Namespace] = None, shard: Optional[Tuple[int, int]] = None,
+                 notifications_queue=None):
+        # in a worker process only accounts of the shard (index, count) are run
+        self.shard = shard
+        self.notifications_queue = notifications_queue
+        self.parse_args(args)
+        self.load_config()
+        self.rate_limiter = RateLimiter(self.config.get('rate_limits', None))
+        self.proxy_health = ProxyHealth()
+        self.http_pool = HTTPPool(**self.config.get('http', {}), rate_limiter=self.rate_limiter,
+                                  proxy_health=self.proxy_health)
+        METRICS.add_collector(self.rate_limiter.collect_metrics)
+        METRICS.add_collector(self.proxy_health.collect_metrics)
+        self.reload_requested = Event()
+        # username -> config and proxies the account was created or last updated with
+        self.account_configs: Dict[str, dict] = {}
+        self.account_proxies: Dict[str, object] = {}
+        self.accounts: Dict[str, 'Account'] = {}
+        # stopped accounts which are still finishing their tick and queued trades
+        self.stopping_accounts: Dict[str, 'Account'] = {}
+        # username -> steam and buff clients of the check sessions mode
+        self.clients: Dict[str, tuple] = {}
+        STARTUP.mark('config')
+        if self.check_sessions:
+            # a one-shot mode, only synchronous clients are built, without notifiers and handled trade ids
+            self.notifiers = []
+            self.session_refresher = None
+            self.trade_store = None
+            self.use_asyncio = False
+            cookie_jars = {}
+            for account_cfg in self.config['accounts']:
+                if self.is_own_account(account_cfg):
+                    cookie_jars[account_cfg['username']] = TrackedCookieJar()
+                    self.clients[account_cfg['username']] = self.create_clients(account_cfg,
+                                                                                cookie_jars[account_cfg['username']])
+
+        else:
+            self.load_notifiers()
+            self.session_refresher = SessionRefresher(self.session_refresh_before) if self.session_refresh else None
+            self.trade_store = TradeIdStore(self.trade_ids_path, self.trade_ids_ttl * 3600) if self.trade_ids_enabled else None
+            self.accounts = {account['username']: self.create_account(account)
+                             for account in self.config['accounts'] if self.is_own_account(account)}
+            cookie_jars = {username: account.cookies for username, account in self.accounts.items()}
+
+        STARTUP.mark('accounts')
+
+        cookies_dir = self.cookies_dir
+        if self.shard is not None and cookies_dir is None:
+            # workers must not overwrite each other's accounts in one cookies file
+            cookies_dir = os.path.splitext(self.cookies_path)[0]
+
+        self.cookies_manager = CookieManager(cookies_dir or self.cookies_path, cookie_jars,
+                                              save_enabled=self.cookies_enabled, sharded=cookies_dir is not None,
+                                              legacy_filename=self.cookies_path)
+        
+        self.cookies_manager.load()
+        STARTUP.mark('cookies')
+
+    def create_account(self, account_cfg):
+        # the clients change the config, so the copy is taken first
+        self.account_configs[account_cfg['username']] = copy.deepcopy(account_cfg)
+        self.account_proxies[account_cfg['username']] = copy.deepcopy(self.get_account_proxies(account_cfg))
+        cookie_jar = TrackedCookieJar()
+        steam, buff = self.create_clients(account_cfg, cookie_jar)
+        if self.use_asyncio:
+            from async_account import AsyncAccount
+            account = AsyncAccount(account_cfg, cookie_jar, steam, buff, scheduler=self.create_scheduler(),
+                                   notifiers=self.notifiers, trade_store=self.trade_store,
+                                   proxy_selector=self.create_proxy_selector(account_cfg),
+                                   session_refresher=self.session_refresher)
+
+        else:
+            from account import Account
+            account = Account(account_cfg, cookie_jar, steam, buff, scheduler=self.create_scheduler(),
+                              notifiers=self.notifiers, trade_store=self.trade_store,
+                              proxy_selector=self.create_proxy_selector(account_cfg),
+                              session_refresher=self.session_refresher)
+
+        # accounts sharing a pool start on the proxy which is best so far
+        account.update_proxies()
+        return account
+
+    def create_clients(self, account_cfg, cookie_jar: TrackedCookieJar):
+        from steam import AdvancedSteamClient
+        steam = AdvancedSteamClient(account_cfg, cookie_jar, http_pool=self.http_pool)
+        if self.use_asyncio:
+            from buff163.async_client import AsyncBuff163Client
+            buff = AsyncBuff163Client(account_cfg, cookie_jar, rate_limiter=self.rate_limiter,
+                                      session_check_ttl=self.session_check_ttl, proxy_health=self.proxy_health)
+
+        else:
+            from buff163.client import Buff163Client
+            buff = Buff163Client(account_cfg, cookie_jar, http_pool=self.http_pool,
+                                 session_check_ttl=self.session_check_ttl)
+
+        if self.check_sessions:
+            # without a proxy selector the first proxy of a pool is used
+            proxies = parse_proxy(self.get_account_proxies(account_cfg))
+            steam.switch_proxies(proxies)
+            buff.switch_proxies(proxies)
+
+        buff.openid_callback = steam.login_openid
+        return steam, buff
+
+    def get_account_proxies(self, account_cfg):
+        # "proxy" can be a list of proxies, "proxy_pool" the name of a pool in the "proxy_pools" section
+        if account_cfg.get('proxy_pool', None) is not None:
+            return self.config.get('proxy_pools', {})[account_cfg['proxy_pool']]
+
+        return account_cfg.get('proxy', None)
+
+    def create_proxy_selector(self, account_cfg) -> Optional[ProxySelector]:
+        proxies = self.get_account_proxies(account_cfg)
+        if not isinstance(proxies, list) or len(proxies) == 0:
+            return None
+
+        return ProxySelector(account_cfg['username'], proxies, self.proxy_health)
+
+    def create_scheduler(self):
+        if self.adaptive_polling:
+            return AdaptivePollScheduler(self.min_refresh_period, self.max_refresh_period)
+
+        return FixedPollScheduler(self.refresh_period)
+
+    def parse_args(self, args: Optional[Namespace] = None):
+        self.args = args if args is not None else create_arg_parser().parse_args()
+        self.config_path: str = self.args.config
+        self.cookies_path: str = self.args.cookies
+        self.cookies_dir: str = self.args.cookies_dir
+        self.cookies_enabled: bool = self.args.cookies_enabled
+        self.trade_ids_path: str = self.args.trade_ids
+        self.trade_ids_enabled: bool = self.args.trade_ids_enabled
+        self.trade_ids_ttl: float = self.args.trade_ids_ttl
+        self.login_check: bool = self.args.login_check
+        self.force_login: bool = self.args.force_login
+        self.session_check_ttl: float = self.args.session_check_ttl
+        self.session_refresh: bool = self.args.session_refresh
+        self.session_refresh_before: float = self.args.session_refresh_before
+        self.startup_workers: int = self.args.startup_workers
+        self.parallel_login: bool = self.args.parallel_login
+        self.check_sessions: bool = self.args.check_sessions
+        self.refresh_period: int = self.args.refresh_period
+        self.adaptive_polling: bool = self.args.adaptive_polling
+        self.min_refresh_period: float = self.args.min_refresh_period
+        self.max_refresh_period: float = self.args.max_refresh_period
+        self.metrics_port: int = self.args.metrics_port
+        self.notify_test: bool = self.args.notify_test
+        self.startup_report: bool = self.args.startup_report
+        self.config_reload: bool = self.args.config_reload
+        self.use_asyncio: bool = self.args.use_asyncio
+        self.max_concurrent_requests: int = self.args.max_concurrent_requests
+        self.supervisor: bool = self.args.supervisor
+        self.workers: int = self.args.workers
+        return self.args
+    
+    def load_config(self):
+        self.config_mtime = os.path.getmtime(self.config_path)
+        self.config = read_config(self.config_path)
+
+    def is_config_changed(self) -> bool:
+        try:
+            return os.path.getmtime(self.config_path) != self.config_mtime
+
+        except OSError:
+            return False
+
+    def reload_config(self):
+        # starts new accounts, stops removed and disabled ones, applies live settings in place
+        # and restarts accounts with other changes. Other sections of the config are not reloaded
+        try:
+            self.load_config()
+            configs = {account_cfg['username']: account_cfg
+                       for account_cfg in self.config['accounts'] if self.is_own_account(account_cfg)}
+            proxies = {username: self.get_account_proxies(account_cfg) for username, account_cfg in configs.items()}
+
+        except (OSError, ValueError, KeyError) as e:
+            print(f'Failed to reload config: {e.__class__.__name__}: {e}')
+            return
 
-        self.known_ids.update(ids_to_send_trade)
+        print('Reloading config')
+        for username in list(self.accounts):
+            if username not in configs:
+                self.remove_account(username)
+                continue
 
-    def check_to_send_offer(self, notifications):
-        ids_to_send_trade = []
-        for game, count in notifications['to_send_offer_order'].items():
-            if count == 0:
+            old_cfg = self.account_configs[username]
+            changed = {key for key in set(old_cfg) | set(configs[username])
+                       if old_cfg.get(key, None) != configs[username].get(key, None)}
+            if not changed.issubset(self.LIVE_SETTINGS):
+                print(f'[{username}] Restarting, changed: {", ".join(sorted(changed))}')
+                self.remove_account(username)
                 continue
 
-            data = self.buff.get_items_to_send_offer(game, count + 5)
-            for item in data['items']:
-                if item['id'] in self.known_ids:
-                    continue
+            if changed or proxies[username] != self.account_proxies[username]:
+                self.update_account(username, configs[username])
+
+        self.sync_accounts()
+
+    def sync_accounts(self):
+        # accounts of the config which are not running are added once their old instance has finished,
+        # so two instances of one account never run at once
+        for username, account in list(self.stopping_accounts.items()):
+            if self.is_account_finished(account):
+                del self.stopping_accounts[username]
+                self.cookies_manager.remove(username)
+                print(f'[{username}] Account finished')
+
+        for account_cfg in self.config['accounts']:
+            username = account_cfg['username']
+            if self.is_own_account(account_cfg) and username not in self.accounts and username not in self.stopping_accounts:
+                self.add_account(account_cfg)
+
+    def is_account_finished(self, account) -> bool:
+        if self.use_asyncio:
+            return account.finished.is_set()
+
+        # trades queued by the account are handled before it finishes, the workers may outlive the account thread
+        return not account.is_alive() and not account.pipeline.is_alive()
+
+    def add_account(self, account_cfg):
+        username = account_cfg['username']
+        print(f'[{username}] Adding account')
+        account = self.create_account(account_cfg)
+        self.accounts[username] = account
+        self.cookies_manager.add(username, account.cookies)
+        if self.use_asyncio:
+            self.async_runner.add_account(account)
+            return
+
+        try:
+            self.start_account(account)
 
-                if not item['is_seller_asked_to_send_offer'] and not item['has_sent_offer']:
-                    ids_to_send_trade.append(item['id'])
+        except Exception as e:
+            print(f'Failed to login {username}: {e.__class__.__name__}: {e}')
+            for notifier in self.notifiers:
+                notifier.notify_exception(username, e)
 
-        if len(ids_to_send_trade) > 0:
-            print(f'[{self.username}] Sending trade offer to seller')
-            self.buff.send_trade_offers('buyer', ids_to_send_trade)
-            print(f'[{self.username}] Success')
+            account.start()
 
-        self.known_ids.update(ids_to_send_trade)
+    def remove_account(self, username: str):
+        print(f'[{username}] Stopping account')
+        account = self.accounts.pop(username)
+        account.stop()
+        self.stopping_accounts[username] = account
+        del self.account_configs[username]
+        del self.account_proxies[username]
 
-    def check_to_accept_offers(self, notifications):
-        if sum(notifications['to_accept_offer_order'].values()) > 0:
-            data = self.buff.get_trades_to_accept()
-            for item in data:
-                self.accept_trade(item['tradeofferid'])
+    def update_account(self, username: str, account_cfg):
+        print(f'[{username}] Updating settings')
+        account = self.accounts[username]
+        account.update_config(account_cfg)
+        account.set_proxies(self.create_proxy_selector(account_cfg), parse_proxy(self.get_account_proxies(account_cfg)))
+        self.account_configs[username] = copy.deepcopy(account_cfg)
+        self.account_proxies[username] = copy.deepcopy(self.get_account_proxies(account_cfg))
 
-    def mainloop(self):
-        while True:
-            notifications = self.buff.get_notifications()
-            if self._account_cfg.get('process_sell_offers', True):
-                self.check_to_deliver(notifications)
-            
-            if self._account_cfg.get('process_buy_offers', True):
-                self.check_to_send_offer(notifications)
-                self.check_to_accept_offers(notifications)
+    def is_own_account(self, account_cfg) -> bool:
+        if not account_cfg.get('enabled', True):
+            return False
 
-            sleep(self.refresh_period)
+        return self.shard is None or get_shard(account_cfg['username'], self.shard[1]) == self.shard[0]
 
-    def run(self):
-        while True:
-            try:
-                self.mainloop()
+    def load_notifiers(self):
+        if self.notifications_queue is not None:
+            # workers send notifications through the supervisor
+            self.notifiers = [QueueNotifier(self.notifications_queue)]
+            return
+
+        self.notifiers = create_notifiers(self.config)
 
-            except:
+    def start_metrics_server(self):
+        # metrics of workers are served by the supervisor
+        if self.metrics_port is not None and self.shard is None:
+            self.metrics_server = MetricsServer(self.metrics_port)
+            self.metrics_server.start()
+
+    def start_all(self):
+        if self.use_asyncio:
+            from async_account import AsyncAccountRunner
+            self.async_runner = AsyncAccountRunner(list(self.accounts.values()), self.max_concurrent_requests,
+                                                   login_check=self.login_check, force_login=self.force_login)
+            self.async_runner.start()
+            return
+
+        start = perf_counter()
+        steam_sessions = {}
+        if self.login_check and not self.force_login:
+            steam_sessions = self.precheck_sessions()
+
+        timings = {}
+        failed = {}
+        if self.parallel_login:
+            with ThreadPoolExecutor(max_workers=self.startup_workers) as executor:
+                futures = {executor.submit(self.start_account, account, steam_sessions.get(account.username, None)): account
+                           for account in self.accounts.values()}
+                for future in as_completed(futures):
+                    account = futures[future]
+                    try:
+                        timings[account.username] = future.result()
+
+                    except Exception as e:
+                        failed[account.username] = e
+                        # the account loop logs in again after the first failed request
+                        account.start()
+
+        else:
+            for account in self.accounts.values():
+                timings[account.username] = self.start_account(account, steam_sessions.get(account.username, None))
+
+        self.print_startup_summary(timings, failed, perf_counter() - start)
+
+    def start_account(self, account: 'Account', steam_alive: Optional[bool] = None) -> float:
+        start = perf_counter()
+        if self.login_check:
+            account.login(force=self.force_login, steam_alive=steam_alive)
+
+        account.start()
+        return perf_counter() - start
+
+    def print_startup_summary(self, timings: Dict[str, float], failed: Dict[str, Exception], total: float):
+        print(f'Started {len(timings)} accounts in {total:.1f}s')
+        if len(timings) > 0:
+            ordered = sorted(timings.values())
+            print(f'Login time per account: min {ordered[0]:.1f}s, median {ordered[len(ordered) // 2]:.1f}s, '
+                  f'max {ordered[-1]:.1f}s')
+
+        for username, exception in failed.items():
+            print(f'Failed to login {username}: {exception.__class__.__name__}: {exception}')
+            for notifier in self.notifiers:
+                notifier.notify_exception(username, exception)
+
+    def precheck_sessions(self) -> Dict[str, Optional[bool]]:
+        # checks steam and buff sessions of all accounts concurrently, so logins do not check them one by one.
+        # Buff results are cached by the clients, steam results are returned by username, None if the check failed
+        with ThreadPoolExecutor(max_workers=self.startup_workers) as executor:
+            for account in self.accounts.values():
+                executor.submit(account.buff.is_session_alive)
+
+            futures = {username: executor.submit(account.steam.is_session_alive)
+                       for username, account in self.accounts.items()}
+            steam_sessions = {}
+            for username, future in futures.items():
                 try:
-                    print(f'[{self.username}] An exception occured')
-                    if time() - self.last_exception < self.EXCEPTION_TIMEOUT:
-                        raise
+                    steam_sessions[username] = future.result()
 
-                    else:
-                        traceback.print_exc()
-                        self.last_exception = time()
+                except Exception:
+                    steam_sessions[username] = None
 
-                    self.login()
+        return steam_sessions
 
-                except Exception as e:
-                    if self.notifiers:
-                        for notifier in self.notifiers:
-                            notifier.notify_exception(self.username, e)
+    def print_rate_limiter_stats(self):
+        for (host, proxy), stats in self.rate_limiter.stats().items():
+            print(f'Rate limit {host}{" via " + strip_proxy_credentials(proxy) if proxy else ""}: {stats["used"]:.0%} used, '
+                  f'{stats["acquired"]} requests, {stats["waited"]} waited {stats["wait_time"]:.1f}s in total, '
+                  f'{stats["waiting"]} waiting')
 
-                    sleep(self.RETRY_FAIL_DELAY)
+    def check_all_sessions(self) -> bool:
+        # sessions are checked concurrently, results are printed in config order
+        all_alive = True
+        with ThreadPoolExecutor(max_workers=self.startup_workers) as executor:
+            futures = {username: ((STEAM, executor.submit(steam.is_session_alive)),
+                                  (BUFF, executor.submit(buff.is_session_alive)))
+                       for username, (steam, buff) in self.clients.items()}
+            for username, checks in futures.items():
+                for side, future in checks:
+                    try:
+                        alive = future.result()
+                        status = 'Session is alive' if alive else 'Session is not alive'
 
+                    except Exception as e:
+                        alive = False
+                        status = f'Failed to check session: {e.__class__.__name__}: {e}'
 
-class Buff163Autotrade:
-    def __init__(self):
-        self.parse_args()
-        self.load_config()
-        self.load_notifiers()
-        self.accounts = {account['username']: Account(account, cookie_jar := RequestsCookieJar(),
-                         AdvancedSteamClient(account, cookie_jar),
-                         Buff163Client(account, cookie_jar),
-                         refresh_period=self.refresh_period, notifiers=self.notifiers)
-                         for account in self.config['accounts'] if account.get('enabled', True)}
-        
-        self.cookies_manager = CookieManager(self.cookies_path,
-                                             {username: account.cookies
-                                              for username, account in self.accounts.items()},
-                                              save_enabled=self.cookies_enabled)
-        
-        self.cookies_manager.load()
-        for account in self.accounts.values():
-            account.buff.openid_callback = account.steam.login_openid
+                    all_alive = all_alive and alive
+                    print(f'Checking {side} session for {username}... {status}')
 
-    def parse_args(self):
-        parser = ArgumentParser(prog='Buff163-autotrade',
-                                description='Tool to automate sending and receiving trades on buff163')
-        
-        parser.add_argument('-c', '--config', default='config.json', help='Path to config file')
-        parser.add_argument('-d', '--cookies', action='store', dest='cookies', default='cookies.json', help='Path to cookies file')
-        parser.add_argument('-n', '--no-cookies', action='store_false', dest='cookies_enabled', help='Do not save cookies file')
-        parser.add_argument('-l', '--no-login-check', action='store_false', dest='login_check', help='Do not check if accounts are logged in')
-        parser.add_argument('-f', '--force-login', action='store_true', dest='force_login', help='Force login all accounts')
-        parser.add_argument('-s', '--check-sessions', action='store_true', dest='check_sessions', help='Check if accounts are logged in and exit')
-        parser.add_argument('-r', '--refresh-period', action='store', dest='refresh_period', default=30, help='Buff trades refresh period', type=int)
-        parser.add_argument('--notify-test', action='store_true', dest='notify_test', help='Test notifications')
-        self.args = parser.parse_args()
-        self.config_path: str = self.args.config
-        self.cookies_path: str = self.args.cookies
-        self.cookies_enabled: bool = self.args.cookies_enabled
-        self.login_check: bool = self.args.login_check
-        self.force_login: bool = self.args.force_login
-        self.check_sessions: bool = self.args.check_sessions
-        self.refresh_period: int = self.args.refresh_period
-        self.notify_test: bool = self.args.notify_test
-        return self.args
-    
-    def load_config(self):
-        with open(self.config_path, 'r') as f:
-            self.config = json.load(f)
+        return all_alive
 
-    def load_notifiers(self):
-        self.notifiers = []
-        if not self.config.get('notifiers', None):
-            return
+    def run(self):
+        atexit.register(self.cookies_manager.save)
+        self.start_metrics_server()
+        self.start_all()
+        STARTUP.mark('login')
+        if self.startup_report:
+            STARTUP.print()
 
-        if 'telegram_bot' in self.config['notifiers']:
-            from notifiers.telegram_bot_notifier import TelegramBotNotifier
-            notifier = TelegramBotNotifier(self.config['notifiers']['telegram_bot'])
-            self.notifiers.append(notifier)
-            notifier.start()
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, lambda signum, frame: self.reload_requested.set())
 
-    def test_notifiers(self):
-        for notifier in self.notifiers:
-            notifier.notify_test()
+        next_maintenance = 0
+        try:
+            while True:
+                if monotonic() >= next_maintenance:
+                    self.cookies_manager.save()
+                    if self.trade_store is not None:
+                        self.trade_store.evict_expired()
 
-    def start_all(self):
-        for account in self.accounts.values():
-            if self.login_check:
-                account.login(force=self.force_login)
+                    self.print_rate_limiter_stats()
+                    next_maintenance = monotonic() + self.MAINTENANCE_PERIOD
 
-            account.start()
+                self.reload_requested.wait(self.CONFIG_CHECK_PERIOD)
+                if self.reload_requested.is_set() or (self.config_reload and self.is_config_changed()):
+                    self.reload_requested.clear()
+                    self.reload_config()
 
-    def check_all_sessions(self):
-        for account in self.accounts.values():
-            print(f'Checking steam session for {account.steam.username}... ', end='')
-            print('Session is alive' if account.steam.is_session_alive() else 'Session is not alive')
-            print(f'Checking buff session for {account.steam.username}... ', end='')
-            print('Session is alive' if account.buff.is_session_alive() else 'Session is not alive')
+                elif len(self.stopping_accounts) > 0:
+                    self.sync_accounts()
+
+        except KeyboardInterrupt:
+            pass
+
+        finally:
+            self.cookies_manager.save()
 
 
 if __name__ == '__main__':
-    autotrade = Buff163Autotrade()
-    if autotrade.check_sessions:
-        autotrade.check_all_sessions()
+    args = create_arg_parser().parse_args()
+    if args.supervisor and not (args.check_sessions or args.notify_test):
+        from supervisor import Supervisor
+        Supervisor(args).run()
         exit(0)
 
-    if autotrade.notify_test:
-        autotrade.test_notifiers()
-        exit(0)
+    if args.check_sessions:
+        all_alive = Buff163Autotrade(args).check_all_sessions()
+        STARTUP.mark('sessions')
+        if args.startup_report:
+            STARTUP.print()
 
-    atexit.register(autotrade.cookies_manager.save)
-    autotrade.start_all()
+        exit(0 if all_alive else 1)
 
-    try:
-        while True:
-            autotrade.cookies_manager.save()
-            sleep(300)
+    if args.notify_test:
+        # accounts are not built to test notifications
+        sent = test_notifiers(read_config(args.config))
+        STARTUP.mark('notify')
+        if args.startup_report:
+            STARTUP.print()
 
-    except KeyboardInterrupt:
-        pass
+        exit(0 if sent else 1)
 
-    finally:
-        autotrade.cookies_manager.save()
+    Buff163Autotrade(args).run()
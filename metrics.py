@@ -0,0 +1,266 @@
+from bisect import bisect_left
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from time import perf_counter
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+import asyncio
+import sys
+
+try:
+    import resource
+
+except ImportError:  # not available on windows
+    resource = None
+
+Labels = Tuple[Tuple[str, str], ...]
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+ORDER_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, 7200)
+
+
+class Metric:
+    TYPE = 'untyped'
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._values: Dict[Labels, object] = {}
+        self._lock = Lock()
+
+    @staticmethod
+    def make_labels(labels: Dict[str, object]) -> Labels:
+        return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def samples(self) -> List[Tuple[str, Labels, float]]:
+        with self._lock:
+            return [('', labels, value) for labels, value in self._values.items()]
+
+    def collect(self) -> dict:
+        return {'name': self.name, 'type': self.TYPE, 'help': self.help, 'samples': self.samples()}
+
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+    def inc(self, value: float = 1, **labels):
+        key = self.make_labels(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+
+class Gauge(Metric):
+    TYPE = 'gauge'
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self.make_labels(labels)] = value
+
+
+class Histogram(Metric):
+    TYPE = 'histogram'
+
+    def __init__(self, name: str, help: str, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self.make_labels(labels)
+        with self._lock:
+            if key not in self._values:
+                # per bucket counts (last one is +Inf), sum
+                self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+
+            counts, total = self._values[key]
+            counts[bisect_left(self.buckets, value)] += 1
+            self._values[key][1] = total + value
+
+    def samples(self) -> List[Tuple[str, Labels, float]]:
+        samples = []
+        with self._lock:
+            for labels, (counts, total) in self._values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    samples.append(('_bucket', labels + (('le', le),), cumulative))
+
+                samples.append(('_sum', labels, total))
+                samples.append(('_count', labels, cumulative))
+
+        return samples
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+        self._collectors: List[Callable[[], Iterable[dict]]] = []
+        self._lock = Lock()
+
+    def _get_or_create(self, cls, name: str, help: str, **kwargs):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = cls(name, help, **kwargs)
+
+            return self._metrics[name]
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self._get_or_create(Counter, name, help)
+
+    def gauge(self, name: str, help: str) -> Gauge:
+        return self._get_or_create(Gauge, name, help)
+
+    def histogram(self, name: str, help: str, buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+        return self._get_or_create(Histogram, name, help, buckets=buckets)
+
+    def add_collector(self, collector: Callable[[], Iterable[dict]]):
+        # collectors are called on every scrape and return metric families like Metric.collect
+        self._collectors.append(collector)
+
+    def collect(self) -> List[dict]:
+        with self._lock:
+            metrics = list(self._metrics.values())
+
+        families = [metric.collect() for metric in metrics]
+        for collector in self._collectors:
+            families.extend(collector())
+
+        return families
+
+    @staticmethod
+    def format_labels(labels: Labels) -> str:
+        if not labels:
+            return ''
+
+        escaped = (key + '="' + value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+                   for key, value in labels)
+        return '{' + ','.join(escaped) + '}'
+
+    @classmethod
+    def render(cls, families: List[dict]) -> str:
+        lines = []
+        seen = set()
+        for family in families:
+            if family['name'] not in seen:
+                seen.add(family['name'])
+                lines.append(f'# HELP {family["name"]} {family["help"]}')
+                lines.append(f'# TYPE {family["name"]} {family["type"]}')
+
+            for suffix, labels, value in family['samples']:
+                lines.append(f'{family["name"]}{suffix}{cls.format_labels(labels)} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = MetricsRegistry()
+
+CLIENT_CALL_SECONDS = METRICS.histogram('autotrade_client_call_seconds',
+                                        'Duration of buff and steam client calls')
+
+TICK_SECONDS = METRICS.histogram('autotrade_tick_seconds', 'Duration of one account poll tick')
+ORDER_ACTION_SECONDS = METRICS.histogram('autotrade_order_action_seconds',
+                                         'Time from an order first being seen to the trade action', ORDER_BUCKETS)
+EXCEPTIONS_TOTAL = METRICS.counter('autotrade_exceptions_total', 'Exceptions raised in account loops')
+RELOGINS_TOTAL = METRICS.counter('autotrade_relogins_total', 'Re-logins after exceptions')
+SESSION_REFRESHES_TOTAL = METRICS.counter('autotrade_session_refreshes_total', 'Logins before sessions expire')
+CIRCUIT_OPEN = METRICS.gauge('autotrade_circuit_open', 'Whether requests to a host are paused after failures')
+PIPELINE_QUEUE_DEPTH = METRICS.gauge('autotrade_pipeline_queue_depth', 'Trade tasks waiting for a worker')
+PIPELINE_TASKS_TOTAL = METRICS.counter('autotrade_pipeline_tasks_total', 'Trade task attempts by result')
+
+
+def _observe_call(client: str, func: Callable, username: Optional[str], start: float, status: str):
+    CLIENT_CALL_SECONDS.observe(perf_counter() - start, client=client, endpoint=func.__name__,
+                                account=username, status=status)
+
+
+def timed(client: str):
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @wraps(func)
+            async def async_wrapper(self, *args, **kwargs):
+                start = perf_counter()
+                status = 'error'
+                try:
+                    result = await func(self, *args, **kwargs)
+                    status = 'ok'
+                    return result
+
+                finally:
+                    _observe_call(client, func, self.username, start, status)
+
+            return async_wrapper
+
+        @wraps(func)
+        def wrapper(self, *args, **kwargs):
+            start = perf_counter()
+            status = 'error'
+            try:
+                result = func(self, *args, **kwargs)
+                status = 'ok'
+                return result
+
+            finally:
+                _observe_call(client, func, self.username, start, status)
+
+        return wrapper
+
+    return decorator
+
+
+class MetricsServer(Thread):
+    THREAD_NAME = 'Metrics server'
+
+    def __init__(self, port: int, collect: Callable[[], List[dict]] = METRICS.collect, host: str = '127.0.0.1'):
+        super().__init__(name=self.THREAD_NAME, daemon=True)
+        collect_metrics = collect
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+
+                body = MetricsRegistry.render(collect_metrics()).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+
+    def run(self):
+        print(f'Serving metrics on http://{self.server.server_address[0]}:{self.server.server_address[1]}/metrics')
+        self.server.serve_forever()
+
+
+def get_max_rss() -> Optional[float]:
+    # in megabytes
+    if resource is None:
+        return None
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / 1024 / 1024 if sys.platform == 'darwin' else max_rss / 1024
+
+
+class StartupReport:
+    # Wall-clock time of start-up phases and peak memory of the process.
+    # Imports of single modules are shown by python -X importtime
+    def __init__(self, start: float):
+        self.start = start
+        self.last = start
+        self.phases: List[Tuple[str, float]] = []
+
+    def mark(self, phase: str):
+        now = perf_counter()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def print(self):
+        phases = ', '.join(f'{phase} {elapsed * 1000:.0f}ms' for phase, elapsed in self.phases)
+        max_rss = get_max_rss()
+        print(f'Start-up took {(self.last - self.start) * 1000:.0f}ms: {phases}'
+              f'{f", max RSS {max_rss:.1f}MB" if max_rss is not None else ""}')
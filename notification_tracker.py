@@ -0,0 +1,49 @@
+from time import monotonic
+from typing import Dict, Optional, Tuple
+
+Snapshot = Tuple[Tuple[Tuple[str, int], ...], Tuple[Tuple[str, object], ...]]
+
+
+class NotificationTracker:
+    # Remembers buff notifications of the last check of every category,
+    # so order lists are fetched again only when counters or updated_at change
+    RECHECK_PERIOD = 300
+
+    def __init__(self, recheck_period: float = RECHECK_PERIOD):
+        # 0 disables tracking, every category is checked on every tick
+        self.recheck_period = recheck_period
+        self.snapshots: Dict[str, Snapshot] = {}
+        self.checked: Dict[str, float] = {}
+
+    @staticmethod
+    def get_snapshot(notifications, category: str) -> Snapshot:
+        counters = tuple(sorted((game, int(count)) for game, count in notifications[category].items()))
+        updated_at = tuple(sorted(notifications.get('updated_at', {}).items()))
+        return counters, updated_at
+
+    def should_check(self, notifications, category: str) -> bool:
+        if self.recheck_period <= 0:
+            return True
+
+        snapshot = self.get_snapshot(notifications, category)
+        if self.snapshots.get(category, None) != snapshot:
+            return True
+
+        # a periodic check catches changes buff does not report
+        return monotonic() - self.checked.get(category, 0) >= self.recheck_period
+
+    def mark_checked(self, notifications, category: str, actions: int):
+        if actions > 0:
+            # trades were queued, buff changes orders state after they are handled
+            self.snapshots.pop(category, None)
+            return
+
+        self.snapshots[category] = self.get_snapshot(notifications, category)
+        self.checked[category] = monotonic()
+
+    def invalidate(self, category: Optional[str] = None):
+        if category is None:
+            self.snapshots.clear()
+
+        else:
+            self.snapshots.pop(category, None)
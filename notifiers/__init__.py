@@ -1 +1,2 @@
-from .base_notifier import BaseNotifier, BaseThreadedNotifier
+from .base_notifier import BaseNotifier, BaseThreadedNotifier, NotificationError
+from .queue_notifier import QueueNotifier, make_remote_exception
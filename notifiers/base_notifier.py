@@ -1,21 +1,130 @@
-from threading import Thread
+from queue import Empty, Queue
+from threading import Event, Lock, Thread
+from time import monotonic
+from typing import Dict, List, Optional, Tuple
 from abc import abstractmethod
 
+
+class NotificationError(Exception):
+    pass
+
+
 class BaseNotifier:
+    # Notifications are queued and sent by a dispatcher thread, so trading threads never wait for them.
+    # Exceptions of one class are coalesced across accounts: a burst is sent as one message after
+    # BATCH_DELAY seconds, then at most once every MIN_INTERVAL seconds
+    BATCH_DELAY = 5
+    MIN_INTERVAL = 60
+    MAX_USERNAMES = 10
+
     def __init__(self, notifier_cfg):
         self._notifier_cfg = notifier_cfg
+        cfg = notifier_cfg or {}
+        self.batch_delay = cfg.get('batch_delay', self.BATCH_DELAY)
+        self.min_interval = cfg.get('min_interval', self.MIN_INTERVAL)
+        self._queue = Queue()
+        self._dispatcher: Optional[Thread] = None
+        self._dispatcher_lock = Lock()
+        # exception class name -> (first queued time, [(username, exception)])
+        self._pending: Dict[str, Tuple[float, List[Tuple[str, Exception]]]] = {}
+        self._last_sent: Dict[str, float] = {}
+        # messages which failed to send, notify raises if a message did not reach every recipient
+        self.failed_sends = 0
 
     @abstractmethod
-    def notify_exception(self, username, exception):
+    def notify(self, message: str):
         pass
 
-    @abstractmethod
+    def notify_exception(self, username, exception):
+        self.put(('exception', username, exception))
+
     def notify_test(self):
-        pass
+        self.put(('message', 'Test notification'))
 
     def start(self):
         pass
 
+    def put(self, item: tuple):
+        with self._dispatcher_lock:
+            if self._dispatcher is None:
+                self._dispatcher = Thread(target=self.dispatch, name=f'{self.__class__.__name__} dispatcher',
+                                          daemon=True)
+                self._dispatcher.start()
+
+        self._queue.put(item)
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        # sends all pending notifications now, returns False if they were not sent in time
+        done = Event()
+        self.put(('flush', done))
+        return done.wait(timeout)
+
+    def send(self, message: str):
+        try:
+            self.notify(message)
+
+        except Exception as e:
+            self.failed_sends += 1
+            print(f'Failed to send notification: {e.__class__.__name__}: {e}')
+
+    @staticmethod
+    def format_exception(username: str, exception: Exception) -> str:
+        exception_str = str(exception)
+        return (f'An exception occurred with a user {username}: '
+                f'{exception.__class__.__name__}{": " + exception_str if exception_str else ""}')
+
+    def format_batch(self, class_name: str, first_queued: float, items: List[Tuple[str, Exception]]) -> str:
+        usernames = list(dict.fromkeys(username for username, _ in items))
+        if len(usernames) == 1:
+            message = self.format_exception(*items[-1])
+            return message if len(items) == 1 else f'{message} ({len(items)} times)'
+
+        listed = ', '.join(usernames[:self.MAX_USERNAMES])
+        if len(usernames) > self.MAX_USERNAMES:
+            listed += f' and {len(usernames) - self.MAX_USERNAMES} more'
+
+        return (f'{len(usernames)} accounts hit {class_name} in the last {monotonic() - first_queued:.0f}s: {listed}. '
+                f'Last: {self.format_exception(*items[-1])}')
+
+    def get_due_time(self, class_name: str) -> float:
+        first_queued, _ = self._pending[class_name]
+        return max(first_queued + self.batch_delay, self._last_sent.get(class_name, -self.min_interval) + self.min_interval)
+
+    def send_pending(self, force: bool = False):
+        now = monotonic()
+        for class_name in list(self._pending):
+            if force or self.get_due_time(class_name) <= now:
+                first_queued, items = self._pending.pop(class_name)
+                self._last_sent[class_name] = now
+                self.send(self.format_batch(class_name, first_queued, items))
+
+    def dispatch(self):
+        while True:
+            timeout = None
+            if self._pending:
+                timeout = max(min(self.get_due_time(class_name) for class_name in self._pending) - monotonic(), 0)
+
+            try:
+                item = self._queue.get(timeout=timeout)
+
+            except Empty:
+                item = None
+
+            if item is not None:
+                if item[0] == 'exception':
+                    _, username, exception = item
+                    class_name = exception.__class__.__name__
+                    self._pending.setdefault(class_name, (monotonic(), []))[1].append((username, exception))
+
+                elif item[0] == 'message':
+                    self.send(item[1])
+
+                elif item[0] == 'flush':
+                    self.send_pending(force=True)
+                    item[1].set()
+
+            self.send_pending()
+
 
 class BaseThreadedNotifier(Thread, BaseNotifier):
     THREAD_NAME = 'Base threaded notifier'
@@ -0,0 +1,21 @@
+from multiprocessing import Queue
+
+from .base_notifier import BaseNotifier
+
+
+def make_remote_exception(class_name: str, message: str) -> Exception:
+    # exceptions raised in workers may not be picklable, so only their class name and message are sent
+    return type(class_name, (Exception,), {})(message)
+
+
+class QueueNotifier(BaseNotifier):
+    # Forwards notifications of a worker process to the supervisor
+    def __init__(self, queue: Queue):
+        super().__init__(None)
+        self.queue = queue
+
+    def notify_exception(self, username, exception):
+        self.queue.put(('exception', username, exception.__class__.__name__, str(exception)))
+
+    def notify_test(self):
+        self.queue.put(('test',))
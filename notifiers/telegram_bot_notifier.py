@@ -1,6 +1,6 @@
 from telebot import TeleBot
 
-from .base_notifier import BaseThreadedNotifier
+from .base_notifier import BaseThreadedNotifier, NotificationError
 
 class TelegramBotNotifier(BaseThreadedNotifier):
     THREAD_NAME = 'Telegram notifier'
@@ -22,19 +22,17 @@ class TelegramBotNotifier(BaseThreadedNotifier):
             self.bot.send_message(message.chat.id, f'Your id: {message.from_user.id}')
 
     def notify(self, message: str):
+        failed = 0
         for user in self._notifier_cfg['whitelist']:
             try:
                 self.bot.send_message(user, message)
 
             except Exception as e:
+                failed += 1
                 print(f'Failed to send notification to user {user}: {e}')
 
-    def notify_exception(self, username, exception):
-        exception_str = str(exception)
-        self.notify(f'An exception occurred with a user {username}: {exception.__class__.__name__}{": " + exception_str if exception_str else ""}')
-
-    def notify_test(self):
-        self.notify('Test notification')
+        if failed > 0:
+            raise NotificationError(f'{failed} of {len(self._notifier_cfg["whitelist"])} users were not notified')
 
     def run(self):
         print('Start telegram bot polling')
@@ -0,0 +1,122 @@
+import traceback
+from enum import Enum
+from queue import Queue
+from threading import Lock, Thread, Timer
+from time import monotonic
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from metrics import PIPELINE_QUEUE_DEPTH, PIPELINE_TASKS_TOTAL
+
+
+class TaskType(Enum):
+    ACCEPT = 'accept'
+    CONFIRM = 'confirm'
+    SEND_SELLER = 'send_seller'
+    SEND_BUYER = 'send_buyer'
+
+
+class TradeTask:
+    __slots__ = ('type', 'ids', 'attempts')
+
+    def __init__(self, task_type: TaskType, ids: List[str]):
+        self.type = task_type
+        # trade offer ids for accept and confirm, buff order ids for sending offers
+        self.ids = ids
+        self.attempts = 0
+
+
+class TradePipeline:
+    # Trade actions found by the account poller are run by worker threads,
+    # so a slow steam confirmation does not delay the next poll
+    MAX_ATTEMPTS = 3
+    RETRY_DELAY = 5
+
+    def __init__(self, username: str, handlers: Dict[TaskType, Callable[[List[str]], None]], workers: int = 2,
+                 on_error: Optional[Callable[[TradeTask, Exception], None]] = None,
+                 on_success: Optional[Callable[[TradeTask], None]] = None):
+        self.username = username
+        self.handlers = handlers
+        self.on_error = on_error
+        self.on_success = on_success
+        self.queue: 'Queue[Optional[TradeTask]]' = Queue()
+        # ids which are queued, running or waiting for a retry
+        self._in_flight: Set[Tuple[TaskType, str]] = set()
+        self._lock = Lock()
+        self._workers = [Thread(target=self.work, name=f'{username} trades {i}', daemon=True)
+                         for i in range(max(workers, 1))]
+
+    def start(self):
+        for worker in self._workers:
+            worker.start()
+
+    def stop(self):
+        # workers exit after the tasks queued so far, retries scheduled later are dropped
+        for _ in self._workers:
+            self.queue.put(None)
+
+    def join(self, timeout: float):
+        # waits for the workers to finish the queued tasks, at most timeout seconds in total
+        deadline = monotonic() + timeout
+        for worker in self._workers:
+            worker.join(max(deadline - monotonic(), 0))
+
+    def is_alive(self) -> bool:
+        return any(worker.is_alive() for worker in self._workers)
+
+    def depth(self) -> int:
+        return self.queue.qsize()
+
+    def _update_depth(self):
+        PIPELINE_QUEUE_DEPTH.set(self.queue.qsize(), account=self.username)
+
+    def submit(self, task_type: TaskType, ids: List[str]) -> List[str]:
+        # returns ids which were queued, ids already in flight are skipped
+        with self._lock:
+            ids = [trade_id for trade_id in dict.fromkeys(ids) if (task_type, trade_id) not in self._in_flight]
+            self._in_flight.update((task_type, trade_id) for trade_id in ids)
+
+        if len(ids) > 0:
+            self.queue.put(TradeTask(task_type, ids))
+            self._update_depth()
+
+        return ids
+
+    def release(self, task: TradeTask):
+        with self._lock:
+            self._in_flight.difference_update((task.type, trade_id) for trade_id in task.ids)
+
+    def retry(self, task: TradeTask):
+        self.queue.put(task)
+        self._update_depth()
+
+    def work(self):
+        while True:
+            task = self.queue.get()
+            self._update_depth()
+            if task is None:
+                return
+
+            task.attempts += 1
+            try:
+                self.handlers[task.type](task.ids)
+
+            except Exception as e:
+                if task.attempts < self.MAX_ATTEMPTS:
+                    print(f'[{self.username}] Failed to {task.type.value} {", ".join(task.ids)}, '
+                          f'retrying ({task.attempts}/{self.MAX_ATTEMPTS}): {e.__class__.__name__}: {e}')
+                    PIPELINE_TASKS_TOTAL.inc(account=self.username, type=task.type.value, status='retry')
+                    Timer(self.RETRY_DELAY * 2 ** (task.attempts - 1), self.retry, (task,)).start()
+                    continue
+
+                traceback.print_exc()
+                PIPELINE_TASKS_TOTAL.inc(account=self.username, type=task.type.value, status='error')
+                self.release(task)
+                if self.on_error is not None:
+                    self.on_error(task, e)
+
+                continue
+
+            PIPELINE_TASKS_TOTAL.inc(account=self.username, type=task.type.value, status='ok')
+            self.release(task)
+            if self.on_success is not None:
+                self.on_success(task)
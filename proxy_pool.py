@@ -0,0 +1,139 @@
+from threading import Lock
+from time import monotonic
+from typing import Dict, List, Optional, Union
+
+from rate_limiter import strip_proxy_credentials
+
+
+def parse_proxy(proxy: Union[str, dict, list, None]) -> Dict[str, str]:
+    # a pool of proxies starts on its first proxy, until a proxy selector picks the best one
+    if isinstance(proxy, list):
+        proxy = proxy[0] if proxy else None
+
+    if proxy is None:
+        return {}
+
+    if isinstance(proxy, str):
+        return {'http': proxy, 'https': proxy}
+
+    return dict(proxy)
+
+
+class ProxyStats:
+    # Rolling latency and error rate of one proxy
+    ALPHA = 0.2  # weight of the newest request
+    DEFAULT_LATENCY = 1.0  # assumed latency of proxies without successful requests
+    ERROR_PENALTY = 10
+    # consecutive failures after which the proxy is not selected for a while
+    MAX_FAILURES = 3
+    COOLDOWN = 60
+    MAX_COOLDOWN = 1800
+
+    def __init__(self):
+        self.latency: Optional[float] = None
+        self.error_rate = 0.0
+        self.failures = 0
+        self.requests = 0
+        self.cooldown_until = 0.0
+
+    def record(self, elapsed: float, ok: bool):
+        self.requests += 1
+        if ok:
+            self.latency = elapsed if self.latency is None else self.latency + self.ALPHA * (elapsed - self.latency)
+            self.error_rate *= 1 - self.ALPHA
+            self.failures = 0
+            return
+
+        self.error_rate += self.ALPHA * (1 - self.error_rate)
+        self.failures += 1
+        if self.failures >= self.MAX_FAILURES:
+            cooldown = min(self.COOLDOWN * 2 ** (self.failures - self.MAX_FAILURES), self.MAX_COOLDOWN)
+            self.cooldown_until = monotonic() + cooldown
+
+    @property
+    def healthy(self) -> bool:
+        return monotonic() >= self.cooldown_until
+
+    @property
+    def score(self) -> float:
+        # lower is better
+        latency = self.latency if self.latency is not None else self.DEFAULT_LATENCY
+        return latency * (1 + self.ERROR_PENALTY * self.error_rate)
+
+
+class ProxyHealth:
+    # Process-wide stats of every proxy, fed by the timings of all requests sent through it
+    def __init__(self):
+        self._stats: Dict[str, ProxyStats] = {}
+        self._lock = Lock()
+
+    def get(self, proxy: str) -> ProxyStats:
+        with self._lock:
+            if proxy not in self._stats:
+                self._stats[proxy] = ProxyStats()
+
+            return self._stats[proxy]
+
+    def record(self, proxy: Optional[str], elapsed: float, ok: bool):
+        if proxy is None:
+            return
+
+        stats = self.get(proxy)
+        with self._lock:
+            stats.record(elapsed, ok)
+
+    def collect_metrics(self) -> List[dict]:
+        with self._lock:
+            stats = dict(self._stats)
+
+        values = {
+            'latency_seconds': ('Rolling latency of requests through the proxy', lambda s: s.latency or 0),
+            'error_rate': ('Rolling share of failed requests through the proxy', lambda s: s.error_rate),
+            'healthy': ('Whether the proxy can be selected', lambda s: int(s.healthy))
+        }
+        families = []
+        for key, (help, getter) in values.items():
+            samples = [('', (('proxy', strip_proxy_credentials(proxy)),), getter(proxy_stats))
+                       for proxy, proxy_stats in stats.items()]
+            families.append({'name': f'autotrade_proxy_{key}', 'type': 'gauge', 'help': help, 'samples': samples})
+
+        return families
+
+
+class ProxySelector:
+    # Picks the best healthy proxy of an account's pool.
+    # The current proxy is kept until it is unhealthy or much worse than the best one, so sessions do not flap
+    SWITCH_FACTOR = 1.5
+
+    def __init__(self, username: str, proxies: List[str], health: ProxyHealth, switch_factor: float = SWITCH_FACTOR):
+        self.username = username
+        self.proxies = proxies
+        self.health = health
+        self.switch_factor = switch_factor
+        self.current: Optional[str] = None
+
+    def select(self) -> str:
+        stats = {proxy: self.health.get(proxy) for proxy in self.proxies}
+        healthy = [proxy for proxy in self.proxies if stats[proxy].healthy]
+        if len(healthy) == 0:
+            # every proxy is cooling down, the one which recovers first is the best guess
+            return min(self.proxies, key=lambda proxy: stats[proxy].cooldown_until)
+
+        return min(healthy, key=lambda proxy: stats[proxy].score)
+
+    def update(self) -> Optional[Dict[str, str]]:
+        # returns the new proxies if the sessions have to be moved
+        best = self.select()
+        if best == self.current:
+            return None
+
+        if self.current is not None:
+            current = self.health.get(self.current)
+            if current.healthy and current.score <= self.health.get(best).score * self.switch_factor:
+                return None
+
+            print(f'[{self.username}] Switching proxy {strip_proxy_credentials(self.current)} '
+                  f'(score {current.score:.2f}) -> {strip_proxy_credentials(best)}')
+
+        self.current = best
+        return parse_proxy(best)
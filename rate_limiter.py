@@ -0,0 +1,185 @@
+import asyncio
+from contextlib import contextmanager
+from contextvars import ContextVar
+from enum import IntEnum
+from threading import Condition, Lock
+from time import monotonic
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+
+
+def strip_proxy_credentials(proxy: Optional[str]) -> str:
+    if not proxy:
+        return ''
+
+    parsed = urlparse(proxy)
+    return f'{parsed.scheme}://{parsed.hostname}:{parsed.port}' if parsed.hostname else proxy
+
+
+class Priority(IntEnum):
+    TRADE = 0  # accepting, confirming and sending trades
+    POLL = 1  # checking notifications and orders
+    BACKGROUND = 2  # session checks and logins
+
+
+_request_priority: ContextVar[Priority] = ContextVar('request_priority', default=Priority.POLL)
+
+
+@contextmanager
+def request_priority(priority: Priority):
+    token = _request_priority.set(priority)
+    try:
+        yield
+
+    finally:
+        _request_priority.reset(token)
+
+
+def get_request_priority() -> Priority:
+    return _request_priority.get()
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.updated = monotonic()
+        self.acquired = 0
+        self.waited = 0
+        self.wait_time = 0.0
+        self._waiting = [0] * len(Priority)
+        self._cond = Condition()
+
+    def _refill(self):
+        now = monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _take(self, priority: Priority) -> float:
+        # returns 0 if a token was taken, otherwise time to wait for the next one
+        self._refill()
+        if self.tokens >= 1 and not any(self._waiting[:priority]):
+            self.tokens -= 1
+            self.acquired += 1
+            return 0
+
+        return max((1 - self.tokens) / self.rate, 0.01)
+
+    def acquire(self, priority: Priority):
+        start = monotonic()
+        with self._cond:
+            delay = self._take(priority)
+            if delay == 0:
+                return
+
+            self._waiting[priority] += 1
+            try:
+                while delay > 0:
+                    self._cond.wait(delay)
+                    delay = self._take(priority)
+
+            finally:
+                self._waiting[priority] -= 1
+                self.waited += 1
+                self.wait_time += monotonic() - start
+                self._cond.notify_all()
+
+    async def acquire_async(self, priority: Priority):
+        # waiting coroutines are counted like waiting threads, so they hold back lower priorities of both
+        start = monotonic()
+        with self._cond:
+            delay = self._take(priority)
+            if delay == 0:
+                return
+
+            self._waiting[priority] += 1
+
+        try:
+            while delay > 0:
+                await asyncio.sleep(delay)
+                with self._cond:
+                    delay = self._take(priority)
+
+        finally:
+            with self._cond:
+                self._waiting[priority] -= 1
+                self.waited += 1
+                self.wait_time += monotonic() - start
+                self._cond.notify_all()
+
+    def stats(self) -> Dict[str, float]:
+        with self._cond:
+            self._refill()
+            return {
+                'rate': self.rate,
+                'burst': self.burst,
+                'tokens': self.tokens,
+                'used': 1 - self.tokens / self.burst,
+                'acquired': self.acquired,
+                'waited': self.waited,
+                'wait_time': self.wait_time,
+                'waiting': sum(self._waiting)
+            }
+
+
+class RateLimiter:
+    # Process-wide token buckets, one for every (host, proxy) pair with a configured limit.
+    # Hosts without a limit (and without a "default" entry) are not limited
+    def __init__(self, limits: Optional[Dict[str, dict]] = None):
+        self.limits = limits or {}
+        self._buckets: Dict[Tuple[str, Optional[str]], TokenBucket] = {}
+        self._lock = Lock()
+
+    def get_bucket(self, host: str, proxy: Optional[str]) -> Optional[TokenBucket]:
+        key = (host, proxy)
+        bucket = self._buckets.get(key, None)
+        if bucket is not None:
+            return bucket
+
+        limit = self.limits.get(host, self.limits.get('default', None))
+        if limit is None:
+            return None
+
+        with self._lock:
+            if key not in self._buckets:
+                self._buckets[key] = TokenBucket(limit['rate'], limit.get('burst', limit['rate']))
+
+            return self._buckets[key]
+
+    def acquire(self, host: str, proxy: Optional[str] = None):
+        bucket = self.get_bucket(host, proxy)
+        if bucket is not None:
+            bucket.acquire(get_request_priority())
+
+    async def acquire_async(self, host: str, proxy: Optional[str] = None):
+        bucket = self.get_bucket(host, proxy)
+        if bucket is not None:
+            await bucket.acquire_async(get_request_priority())
+
+    def stats(self) -> Dict[Tuple[str, Optional[str]], Dict[str, float]]:
+        with self._lock:
+            buckets = dict(self._buckets)
+
+        return {key: bucket.stats() for key, bucket in buckets.items()}
+
+    def collect_metrics(self) -> List[dict]:
+        gauges = {
+            'used': 'Share of the rate limit bucket in use',
+            'waiting': 'Requests waiting for a rate limit token'
+        }
+        counters = {
+            'acquired': 'Requests that passed the rate limiter',
+            'waited': 'Requests that had to wait for the rate limiter',
+            'wait_time': 'Total time requests waited for the rate limiter'
+        }
+        stats = self.stats()
+        families = []
+        for metric_type, metrics in (('gauge', gauges), ('counter', counters)):
+            for key, help in metrics.items():
+                samples = [('', (('host', host), ('proxy', strip_proxy_credentials(proxy))), bucket_stats[key])
+                           for (host, proxy), bucket_stats in stats.items()]
+                families.append({'name': f'autotrade_rate_limit_{key}', 'type': metric_type, 'help': help,
+                                 'samples': samples})
+
+        return families
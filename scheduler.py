@@ -0,0 +1,36 @@
+import random
+
+
+class FixedPollScheduler:
+    def __init__(self, refresh_period: float):
+        self.refresh_period = refresh_period
+
+    def start_delay(self) -> float:
+        return 0
+
+    def next_delay(self, busy: bool) -> float:
+        return self.refresh_period
+
+
+class AdaptivePollScheduler:
+    # Polls every min_interval while an account has work, and multiplies the interval
+    # by backoff_factor after every idle tick, up to max_interval
+    def __init__(self, min_interval: float, max_interval: float, backoff_factor: float = 2, jitter: float = 0.2):
+        self.min_interval = min_interval
+        self.max_interval = max(max_interval, min_interval)
+        self.backoff_factor = backoff_factor
+        self.jitter = jitter
+        self.interval = min_interval
+
+    def start_delay(self) -> float:
+        # spread first polls of all accounts over the shortest interval
+        return random.uniform(0, self.min_interval)
+
+    def next_delay(self, busy: bool) -> float:
+        if busy:
+            self.interval = self.min_interval
+
+        else:
+            self.interval = min(self.interval * self.backoff_factor, self.max_interval)
+
+        return self.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
@@ -0,0 +1,114 @@
+import base64
+import json
+import zlib
+from threading import Lock
+from time import monotonic, time
+from typing import Dict, Optional, Set
+from requests.cookies import RequestsCookieJar
+
+from circuit_breaker import BUFF, STEAM
+
+
+def get_jwt_expiry(token: str) -> Optional[float]:
+    try:
+        payload = token.split('.')[1]
+        return float(json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))['exp'])
+
+    except (IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
+def get_cookie_expiry(cookie_jar: RequestsCookieJar, name: str, domain: str) -> Optional[float]:
+    for cookie in list(cookie_jar):
+        if cookie.name == name and cookie.domain.lstrip('.') == domain and cookie.value:
+            if name == 'steamLoginSecure':
+                # the cookie itself usually has no expiry, its access token has one
+                expiry = get_jwt_expiry(cookie.value.replace('%7C%7C', '||').split('||')[-1])
+                if expiry is not None:
+                    return expiry
+
+            return cookie.expires
+
+    return None
+
+
+def get_session_expiry(cookie_jar: RequestsCookieJar) -> Dict[str, Optional[float]]:
+    steam_expiries = [expiry for expiry in (get_cookie_expiry(cookie_jar, 'steamLoginSecure', 'steamcommunity.com'),
+                                            get_cookie_expiry(cookie_jar, 'steamRefresh_steam', 'login.steampowered.com'))
+                      if expiry is not None]
+    return {
+        STEAM: min(steam_expiries) if steam_expiries else None,
+        BUFF: get_cookie_expiry(cookie_jar, 'session', 'buff.163.com')
+    }
+
+
+class SessionRefresher:
+    # Process-wide schedule of proactive logins. A session is refreshed REFRESH_BEFORE seconds before
+    # its cookies expire, plus a per-account offset. Up to MAX_CONCURRENT refreshes run at once, started
+    # at least MIN_INTERVAL seconds apart, and the offsets are spread over at least STAGGER seconds or
+    # over the time all accounts need at that pace, so sessions of accounts which logged in together
+    # are not all due at once
+    REFRESH_BEFORE = 3600
+    STAGGER = 1800
+    MIN_INTERVAL = 10
+    MAX_CONCURRENT = 4
+    RETRY_DELAY = 600
+
+    def __init__(self, refresh_before: float = REFRESH_BEFORE, stagger: float = STAGGER,
+                 min_interval: float = MIN_INTERVAL, max_concurrent: int = MAX_CONCURRENT,
+                 retry_delay: float = RETRY_DELAY):
+        self.refresh_before = refresh_before
+        self.stagger = stagger
+        self.min_interval = min_interval
+        self.max_concurrent = max_concurrent
+        self.retry_delay = retry_delay
+        # usernames of running refreshes
+        self.running: Set[str] = set()
+        self.last_start = -min_interval
+        # accounts which asked for a refresh, the stagger grows with their number
+        self.usernames: Set[str] = set()
+        # username -> time before which a failed refresh is not retried
+        self.retry_at: Dict[str, float] = {}
+        self._lock = Lock()
+
+    def get_stagger(self) -> float:
+        return max(self.stagger, len(self.usernames) * self.min_interval)
+
+    def get_refresh_time(self, username: str, expiry: float) -> float:
+        offset = self.get_stagger() * zlib.crc32(username.encode()) / 2 ** 32
+        return expiry - self.refresh_before - offset
+
+    def get_due_side(self, username: str, cookie_jar: RequestsCookieJar) -> Optional[str]:
+        self.usernames.add(username)
+        if monotonic() < self.retry_at.get(username, 0):
+            return None
+
+        now = time()
+        expiries = get_session_expiry(cookie_jar)
+        # steam first, buff logs in through steam openid
+        for side in (STEAM, BUFF):
+            expiry = expiries[side]
+            # sessions which already expired are refreshed too, an idle account may not notice it soon
+            if expiry is not None and self.get_refresh_time(username, expiry) <= now:
+                return side
+
+        return None
+
+    def try_acquire(self, username: str) -> bool:
+        with self._lock:
+            if (username in self.running or len(self.running) >= self.max_concurrent
+                    or monotonic() - self.last_start < self.min_interval):
+                return False
+
+            self.running.add(username)
+            self.last_start = monotonic()
+            return True
+
+    def release(self, username: str, ok: bool):
+        with self._lock:
+            self.running.discard(username)
+            if ok:
+                self.retry_at.pop(username, None)
+
+            else:
+                self.retry_at[username] = monotonic() + self.retry_delay
@@ -1,13 +1,16 @@
-from typing import Dict, Tuple
-from requests import Response
+from typing import Dict, List, Optional, Tuple
+from requests import Response, Session
 from requests.cookies import RequestsCookieJar
 from steampy.client import SteamClient
+from steampy.confirmation import Confirmation, ConfirmationExecutor, Tag
 from steampy.login import LoginExecutor
 from steampy.models import SteamUrl
 from steampy.utils import create_cookie
-from lxml import html
 
-from exceptions import SteamHTTPCodeError
+from exceptions import SteamConfirmationError, SteamHTTPCodeError, SteamSessionError
+from http_pool import HTTPPool
+from metrics import timed
+from proxy_pool import parse_proxy
 
 class LoginExecutorFix(LoginExecutor):
     # Temporary steampy fix
@@ -35,31 +38,42 @@ class LoginExecutorFix(LoginExecutor):
 class AdvancedSteamClient(SteamClient):
     USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/121.0.0.0 Safari/537.36'
 
-    def __init__(self, account_cfg, cookie_jar: RequestsCookieJar):
+    def __init__(self, account_cfg, cookie_jar: RequestsCookieJar, http_pool: Optional[HTTPPool] = None):
         super().__init__(account_cfg['api_key'])
         self._session.headers['User-Agent'] = self.USER_AGENT
         self._account_cfg = account_cfg
         self._session.cookies = cookie_jar
         if not self._account_cfg.get('trade_confirmations', True):
             self._confirm_transaction = lambda *args, **kwargs: None
+            self.confirm_transactions = lambda trade_offer_ids: list(trade_offer_ids)
 
-        if 'proxy' in self._account_cfg and self._account_cfg['proxy'] is not None:
-            if isinstance(self._account_cfg['proxy'], str):
-                self._session.proxies.update({'http': self._account_cfg['proxy'], 'https': self._account_cfg['proxy']})
-
-            else:
-                self._session.proxies.update(self._account_cfg['proxy'])
-
+        self.http_pool = http_pool
+        self.switch_proxies(parse_proxy(self._account_cfg.get('proxy', None)))
         self.steam_guard = self._account_cfg['steamguard']
         self.steam_guard['steamid'] = str(self.steam_guard['steamid'])
         self.username = self._account_cfg['username']
         self._password = self._account_cfg['password']
         self.was_login_executed = True
 
-    def login(self, force=False) -> bool:
+    def switch_proxies(self, proxies: Dict[str, str]):
+        # unlike set_proxies, the proxy is not pinged, a dead one is left by the proxy selector
+        self.proxies = proxies
+        if self.http_pool is not None:
+            self.http_pool.configure_session(self._session, self.proxies)
+
+        else:
+            # requests of other threads see either the old or the new proxies
+            self._session.proxies = dict(self.proxies)
+
+    @timed('steam')
+    def login(self, force=False, alive: Optional[bool] = None) -> bool:
+        # alive is the result of a session check made beforehand, the session is checked here if it is None
         if not force:
             print(f'Checking steam session for {self.username}... ', end='')
-            if self.is_session_alive():
+            if alive is None:
+                alive = self.is_session_alive()
+
+            if alive:
                 print('Session is alive')
                 return False
 
@@ -84,8 +98,31 @@ class AdvancedSteamClient(SteamClient):
         print('OK')
         return True
 
+    @timed('steam')
+    def refresh_session(self):
+        # logs in with a separate session and then copies its cookies over the old ones,
+        # so requests of other threads keep using the old session until the new one is ready
+        session = Session()
+        session.headers['User-Agent'] = self.USER_AGENT
+        if self.http_pool is not None:
+            self.http_pool.configure_session(session, self.proxies)
+
+        else:
+            session.proxies.update(self.proxies)
+
+        session.cookies.set('steamRememberLogin', 'true')
+        login_executor = LoginExecutorFix(self.username, self._password, self.steam_guard['shared_secret'], session)
+        login_executor.login()
+        session.cookies.set('steamRememberLogin', None)
+        for cookie in session.cookies:
+            self._session.cookies.set_cookie(cookie)
+
+        self.market._set_login_executed(self.steam_guard, self._get_session_id())
+
     @staticmethod
     def parse_openid_params(resp: str) -> Dict[str, str]:
+        # lxml is only needed to log in buff
+        from lxml import html
         parser = html.document_fromstring(resp)
         params = {
             'action': '',
@@ -106,6 +143,7 @@ class AdvancedSteamClient(SteamClient):
         
         return resp.url, self.parse_openid_params(resp.text)
     
+    @timed('steam')
     def login_openid(self, url: str) -> Response:
         referer, data = self.get_openid_params(url)
         headers = {
@@ -120,6 +158,90 @@ class AdvancedSteamClient(SteamClient):
         
         return resp
     
+    @timed('steam')
+    def is_session_alive(self) -> bool:
+        return super().is_session_alive()
+
+    @timed('steam')
+    def accept_trade_offer(self, trade_offer_id: str) -> dict:
+        return super().accept_trade_offer(trade_offer_id)
+
+    @timed('steam')
+    def _confirm_transaction(self, trade_offer_id: str) -> dict:
+        return super()._confirm_transaction(trade_offer_id)
+
+    def _get_confirmation_executor(self) -> ConfirmationExecutor:
+        return ConfirmationExecutor(self.steam_guard['identity_secret'], self.steam_guard['steamid'], self._session)
+
+    def get_trade_confirmations(self, executor: ConfirmationExecutor) -> Dict[str, Confirmation]:
+        # trade offer id -> confirmation, the list has offer ids so no details pages are fetched
+        resp = executor._fetch_confirmations_page()
+        if not resp.ok:
+            raise SteamHTTPCodeError(f'Failed to get confirmations. Code {resp.status_code}')
+
+        jresp = resp.json()
+        if jresp.get('needauth', False):
+            raise SteamSessionError('Failed to get confirmations. User is not logged in')
+
+        if not jresp.get('success', False):
+            raise SteamConfirmationError(f'Failed to get confirmations: {jresp.get("message", "")}')
+
+        return {str(conf['creator_id']): Confirmation(conf['id'], conf['nonce']) for conf in jresp.get('conf', [])}
+
+    def send_multi_confirmation(self, executor: ConfirmationExecutor, confirmations: List[Confirmation]) -> bool:
+        params = executor._create_confirmation_params(Tag.ALLOW.value)
+        params['op'] = Tag.ALLOW.value
+        params['cid[]'] = [confirmation.data_confid for confirmation in confirmations]
+        params['ck[]'] = [confirmation.nonce for confirmation in confirmations]
+        headers = {'X-Requested-With': 'XMLHttpRequest'}
+        resp = self._session.post(f'{executor.CONF_URL}/multiajaxop', data=params, headers=headers)
+        return resp.ok and resp.json().get('success', False)
+
+    @timed('steam')
+    def confirm_transactions(self, trade_offer_ids: List[str]) -> List[str]:
+        # Confirms all offers with one list request and one multi-confirm request.
+        # Returns ids of confirmed offers, offers without a confirmation are skipped
+        executor = self._get_confirmation_executor()
+        confirmations = self.get_trade_confirmations(executor)
+        matched = {trade_offer_id: confirmations[trade_offer_id]
+                   for trade_offer_id in trade_offer_ids if trade_offer_id in confirmations}
+        if len(matched) == 0:
+            return []
+
+        try:
+            if self.send_multi_confirmation(executor, list(matched.values())):
+                return list(matched)
+
+        except Exception as e:
+            print(f'[{self.username}] Multi-confirmation failed: {e.__class__.__name__}: {e}')
+
+        confirmed = []
+        for trade_offer_id, confirmation in matched.items():
+            if executor._send_confirmation(confirmation).get('success', False):
+                confirmed.append(trade_offer_id)
+
+        return confirmed
+
+    @timed('steam')
+    def get_trade_offer_states(self, historical_cutoff: int) -> Dict[str, int]:
+        # active offers and offers which changed state after the cutoff, without item descriptions
+        params = {
+            'key': self._api_key,
+            'get_sent_offers': 1,
+            'get_received_offers': 1,
+            'get_descriptions': 0,
+            'active_only': 1,
+            'historical_only': 0,
+            'time_historical_cutoff': historical_cutoff
+        }
+        resp = self.api_call('GET', 'IEconService', 'GetTradeOffers', 'v1', params)
+        if not resp.ok:
+            raise SteamHTTPCodeError(f'Failed to get trade offers. Code {resp.status_code}')
+
+        jresp = resp.json().get('response', {})
+        offers = jresp.get('trade_offers_sent', []) + jresp.get('trade_offers_received', [])
+        return {str(offer['tradeofferid']): offer['trade_offer_state'] for offer in offers}
+
     # Temporary steampy fix
     def _get_session_id(self) -> str:
         return self._session.cookies.get('sessionid', domain='steamcommunity.com')
@@ -0,0 +1,218 @@
+import json
+import multiprocessing
+import os
+import queue
+import signal
+import zlib
+from argparse import Namespace
+from threading import Event, Lock, Thread
+from time import monotonic, sleep
+from typing import Dict, List, Optional, Tuple
+
+METRICS_REPORT_PERIOD = 15
+MIN_RESTART_DELAY = 5
+MAX_RESTART_DELAY = 300
+# workers which ran longer than this are restarted without backoff
+STABLE_RUN_TIME = 600
+STOP_TIMEOUT = 30
+
+
+def get_shard(username: str, shards: int) -> int:
+    # stable across runs and processes, unlike hash()
+    return zlib.crc32(username.encode('utf-8')) % shards
+
+
+class MetricsReporter(Thread):
+    THREAD_NAME = 'Metrics reporter'
+
+    def __init__(self, queue: multiprocessing.Queue, worker: int, period: float = METRICS_REPORT_PERIOD):
+        super().__init__(name=self.THREAD_NAME, daemon=True)
+        self.queue = queue
+        self.worker = worker
+        self.period = period
+
+    def run(self):
+        from metrics import METRICS
+        while True:
+            self.queue.put(('metrics', self.worker, METRICS.collect()))
+            sleep(self.period)
+
+
+def run_worker(args: Namespace, shard: Tuple[int, int], queue: multiprocessing.Queue):
+    if hasattr(signal, 'SIGHUP'):
+        # the supervisor's handler is not inherited, the worker installs its own once it runs
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    from main import Buff163Autotrade
+    autotrade = Buff163Autotrade(args, shard=shard, notifications_queue=queue)
+    if args.metrics_port is not None:
+        MetricsReporter(queue, shard[0]).start()
+
+    autotrade.run()
+
+
+class Supervisor:
+    # Runs accounts in worker processes, so CPU work of one account does not hold the GIL for the others.
+    # Notifications and metrics of workers are sent to the supervisor through a queue
+    def __init__(self, args: Namespace):
+        self.args = args
+        self.load_config()
+        self.workers = max(args.workers, 1)
+        self.queue = multiprocessing.Queue()
+        self.processes: Dict[int, multiprocessing.Process] = {}
+        self.started: Dict[int, float] = {}
+        self.restart_delay: Dict[int, float] = {}
+        self.restart_at: Dict[int, float] = {}
+        self.metrics: Dict[int, List[dict]] = {}
+        self.metrics_lock = Lock()
+        self.stopping = Event()
+        self.reload_requested = Event()
+
+    def load_config(self):
+        self.config_mtime = os.path.getmtime(self.args.config)
+        with open(self.args.config, 'r') as f:
+            self.config = json.load(f)
+
+    def is_config_changed(self) -> bool:
+        try:
+            return os.path.getmtime(self.args.config) != self.config_mtime
+
+        except OSError:
+            return False
+
+    def reload_config(self):
+        # workers apply the changes of their own shards, the supervisor starts workers of shards which gained accounts
+        try:
+            self.load_config()
+
+        except (OSError, ValueError) as e:
+            print(f'Failed to reload config: {e.__class__.__name__}: {e}')
+            return
+
+        for index in self.get_shards():
+            if index not in self.processes:
+                self.start_worker(index)
+
+    def request_reload(self):
+        # SIGHUP is forwarded, so workers re-read the config at once too
+        self.reload_requested.set()
+        for process in self.processes.values():
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGHUP)
+
+    def get_shards(self) -> List[int]:
+        # workers without accounts are not started
+        usernames = [account['username'] for account in self.config['accounts'] if account.get('enabled', True)]
+        return sorted({get_shard(username, self.workers) for username in usernames})
+
+    def start_worker(self, index: int):
+        process = multiprocessing.Process(target=run_worker, args=(self.args, (index, self.workers), self.queue),
+                                          name=f'Worker {index}')
+        process.start()
+        self.processes[index] = process
+        self.started[index] = monotonic()
+        print(f'Started worker {index} (pid {process.pid})')
+
+    def check_workers(self):
+        now = monotonic()
+        for index, process in self.processes.items():
+            if process.is_alive():
+                continue
+
+            if index not in self.restart_at:
+                delay = self.restart_delay.get(index, 0) * 2
+                if now - self.started[index] > STABLE_RUN_TIME:
+                    delay = 0
+
+                delay = min(max(delay, MIN_RESTART_DELAY), MAX_RESTART_DELAY)
+                self.restart_delay[index] = delay
+                self.restart_at[index] = now + delay
+                print(f'Worker {index} exited with code {process.exitcode}, restarting in {delay:.0f}s')
+                with self.metrics_lock:
+                    self.metrics.pop(index, None)
+
+            elif now >= self.restart_at[index]:
+                del self.restart_at[index]
+                self.start_worker(index)
+
+    def dispatch(self, notifiers):
+        from notifiers import make_remote_exception
+        while not self.stopping.is_set():
+            try:
+                message = self.queue.get(timeout=1)
+
+            except queue.Empty:
+                continue
+
+            if message[0] == 'exception':
+                _, username, class_name, text = message
+                for notifier in notifiers:
+                    notifier.notify_exception(username, make_remote_exception(class_name, text))
+
+            elif message[0] == 'test':
+                for notifier in notifiers:
+                    notifier.notify_test()
+
+            elif message[0] == 'metrics':
+                _, worker, families = message
+                with self.metrics_lock:
+                    self.metrics[worker] = families
+
+    def collect_metrics(self) -> List[dict]:
+        # samples of all workers are merged into one family per metric, labelled by worker
+        with self.metrics_lock:
+            metrics = dict(self.metrics)
+
+        merged: Dict[str, dict] = {}
+        for worker, families in sorted(metrics.items()):
+            for family in families:
+                if family['name'] not in merged:
+                    merged[family['name']] = dict(family, samples=[])
+
+                merged[family['name']]['samples'].extend(
+                    (suffix, (('worker', str(worker)),) + labels, value) for suffix, labels, value in family['samples'])
+
+        return list(merged.values())
+
+    def start_metrics_server(self):
+        if self.args.metrics_port is not None:
+            from metrics import MetricsServer
+            self.metrics_server = MetricsServer(self.args.metrics_port, collect=self.collect_metrics)
+            self.metrics_server.start()
+
+    def stop(self, timeout: Optional[float] = STOP_TIMEOUT):
+        self.stopping.set()
+        deadline = monotonic() + timeout
+        for process in self.processes.values():
+            process.join(max(deadline - monotonic(), 0))
+            if process.is_alive():
+                process.terminate()
+
+    def run(self):
+        from main import create_notifiers
+        notifiers = create_notifiers(self.config)
+        Thread(target=self.dispatch, args=(notifiers,), name='Notifications dispatcher', daemon=True).start()
+        self.start_metrics_server()
+
+        shards = self.get_shards()
+        print(f'Running {len(shards)} workers')
+        for index in shards:
+            self.start_worker(index)
+
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, lambda signum, frame: self.request_reload())
+
+        try:
+            while True:
+                self.reload_requested.wait(1)
+                self.check_workers()
+                if self.reload_requested.is_set() or (self.args.config_reload and self.is_config_changed()):
+                    self.reload_requested.clear()
+                    self.reload_config()
+
+        except KeyboardInterrupt:
+            pass
+
+        finally:
+            # workers receive the interrupt too and save their cookies before exiting
+            self.stop()
@@ -0,0 +1,53 @@
+from threading import Lock
+from time import time
+from typing import Dict, Optional
+
+from steampy.models import TradeOfferState
+
+
+class TradeOfferCache:
+    # Steam states of recent trade offers of one account, refreshed with one GetTradeOffers call per poll.
+    # Offers which steam has already accepted, declined or cancelled are skipped without a request
+    HISTORY_WINDOW = 24 * 3600
+
+    def __init__(self, steam, history_window: float = HISTORY_WINDOW):
+        self.steam = steam
+        self.history_window = history_window
+        # trade offer id -> trade offer state
+        self.states: Dict[str, int] = {}
+        self.stale = True
+        self._lock = Lock()
+
+    def invalidate(self):
+        # called once per poll, the offers are requested only if a state is needed
+        self.stale = True
+
+    def refresh(self):
+        try:
+            states = self.steam.get_trade_offer_states(int(time() - self.history_window))
+
+        except Exception as e:
+            # without states every action is attempted, as if there was no cache
+            print(f'[{self.steam.username}] Failed to get trade offer states: {e.__class__.__name__}: {e}')
+            states = {}
+
+        self.states = states
+        self.stale = False
+
+    def get_state(self, trade_offer_id: str) -> Optional[int]:
+        with self._lock:
+            if self.stale:
+                self.refresh()
+
+            return self.states.get(trade_offer_id, None)
+
+    def set_state(self, trade_offer_id: str, state: int):
+        self.states[trade_offer_id] = state
+
+    def get_skip_reason(self, trade_offer_id: str, expected_state: TradeOfferState) -> Optional[str]:
+        # returns the name of the offer state if the offer is known to be in another state
+        state = self.get_state(trade_offer_id)
+        if state is None or state == expected_state:
+            return None
+
+        return TradeOfferState(state).name if state in TradeOfferState._value2member_map_ else str(state)
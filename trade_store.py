@@ -0,0 +1,93 @@
+from collections import OrderedDict
+from threading import Lock
+from time import time
+from typing import Iterable, List, Optional
+import sqlite3
+
+
+class TradeIdStore:
+    # Trade ids already handled by accounts, persisted so restarts do not repeat steam and buff calls
+    def __init__(self, filename: str, ttl: float):
+        self.filename = filename
+        self.ttl = ttl
+        self._lock = Lock()
+        self._conn = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS trade_ids (username TEXT NOT NULL, kind TEXT NOT NULL, '
+                           'id TEXT NOT NULL, added REAL NOT NULL, PRIMARY KEY (username, kind, id)) WITHOUT ROWID')
+        self.evict_expired()
+
+    def evict_expired(self):
+        with self._lock:
+            self._conn.execute('DELETE FROM trade_ids WHERE added < ?', (time() - self.ttl,))
+
+    def load(self, username: str, kind: str) -> List[tuple]:
+        with self._lock:
+            return self._conn.execute('SELECT id, added FROM trade_ids WHERE username = ? AND kind = ? AND added >= ? '
+                                      'ORDER BY added', (username, kind, time() - self.ttl)).fetchall()
+
+    def add(self, username: str, kind: str, ids: Iterable[str], added: float):
+        with self._lock:
+            self._conn.executemany('INSERT OR REPLACE INTO trade_ids VALUES (?, ?, ?, ?)',
+                                   ((username, kind, trade_id, added) for trade_id in ids))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class TradeIdSet:
+    # Set of ids bounded in size (least recently used ids are dropped) and in time,
+    # additions are written through to the store
+    MAX_SIZE = 10000
+    TTL = 7 * 24 * 3600
+
+    def __init__(self, username: str, kind: str, store: Optional[TradeIdStore] = None,
+                 max_size: int = MAX_SIZE, ttl: float = TTL):
+        self.username = username
+        self.kind = kind
+        self.store = store
+        self.max_size = max_size
+        self.ttl = store.ttl if store is not None else ttl
+        self._lock = Lock()
+        self._ids = OrderedDict()
+        if store is not None:
+            for trade_id, added in store.load(username, kind)[-max_size:]:
+                self._ids[trade_id] = added
+
+    def __contains__(self, trade_id: str) -> bool:
+        with self._lock:
+            added = self._ids.get(trade_id, None)
+            if added is None:
+                return False
+
+            if time() - added > self.ttl:
+                del self._ids[trade_id]
+                return False
+
+            self._ids.move_to_end(trade_id)
+            return True
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def add(self, trade_id: str):
+        self.update((trade_id,))
+
+    def update(self, ids: Iterable[str]):
+        ids = list(ids)
+        if len(ids) == 0:
+            return
+
+        added = time()
+        with self._lock:
+            for trade_id in ids:
+                self._ids[trade_id] = added
+                self._ids.move_to_end(trade_id)
+
+            while len(self._ids) > self.max_size:
+                self._ids.popitem(last=False)
+
+        if self.store is not None:
+            self.store.add(self.username, self.kind, ids, added)